@@ -4,7 +4,7 @@ import argparse
 import os
 
 # error messages
-INVALID_FILETYPE_MSG = "Error: Invalid file format. {} must be a .txt file."
+INVALID_FILETYPE_MSG = "Error: Invalid file format. {} must be a .json or .jsonl file."
 INVALID_PATH_MSG = "Error: Invalid file path/name. Path {} does not exist."
   
   
@@ -22,42 +22,131 @@ def validate_file(file_name):
       
 def valid_filetype(file_name):
     # validate file type
-    return file_name.endswith('.json')
+    return file_name.endswith('.json') or file_name.endswith('.jsonl')
   
 def valid_path(path):
     # validate file path
     return os.path.exists(path)
 
+def write_metrics(args, metrics, performance):
+    # Export the measurements of the stages if requested
+    if args.metrics:
+        metrics.dump(args.metrics[0], performance=performance)
+        print('Metrics written to: ' + args.metrics[0])
+    elif args.quiet:
+        print('\n'.join(['{:>22}: {}'.format(k,v) for k, v in performance.items()]))
+
 def main():
     parser = argparse.ArgumentParser(description='Product duplicate detection program.')
 
-    parser.add_argument('file', nargs=1, metavar='FILE', type=str, help='A JSON file containing all the products indexed by their model IDs')
+    parser.add_argument('file', nargs='?', metavar='FILE', type=str, help='A JSON file containing all the products indexed by their model IDs')
 
     parser.add_argument('--train', action='store_true', help='Train the algorithm using 5 bootstraps.')
+    parser.add_argument('--search', choices=['grid', 'halving'], default='grid', help='Search of the band configurations in training: all on every bootstrap, or successive halving, which evaluates them on samples of the bootstrap and only the best ones on the full bootstrap. Default: grid')
     parser.add_argument('--test', nargs=1, type=str, metavar='TRAIN_DIR', help='Test on out-of-bag bootstrap samples using result from bootstrap optimization. TRAIN_DIR is the directory containing bootstrap-i-results.json. This is usually the results/ directory.')
     parser.add_argument('--lsh-sim', nargs=1, metavar='LSH_SIM', type=float, help='Threshold similarity for determining LSH bands. Default 0.999')
+    parser.add_argument('--scheme', choices=['minhash', 'oph'], default='minhash', help='Signature scheme: regular minhashing or one-permutation hashing with densification. Default: minhash')
+    parser.add_argument('--candidates', choices=['lsh', 'forest', 'join'], default='lsh', help='Regular candidate generation: LSH on the signatures, an LSH forest that picks the band length for LSH_SIM from all lengths instead of the divisors of the signature length, or an exact similarity join of the word sets at the similarity threshold SIM (detection and benchmark only). Default: lsh')
+    parser.add_argument('--bits', type=int, choices=[1, 2, 4, 8], help='Keep only the lowest BITS bits of every signature value, packed into bytes (b-bit minwise hashing; detection and benchmark only). Default: full 32-bit values')
+    parser.add_argument('--blocking', action='store_true', help='Only compare products of different shops, and drop candidates with conflicting brands before classification (detection and benchmark only).')
+    parser.add_argument('--compare-schemes', action='store_true', help='Compare the accuracy of the signature schemes on 5 bootstraps.')
+    parser.add_argument('--workers', nargs=1, metavar='N', type=int, help='Number of worker processes for training and testing, and for the LSH bands of detection and benchmarks. Default: 1')
+    parser.add_argument('--cache-dir', nargs=1, metavar='DIR', type=str, help='Directory of the signature cache. Default: cache/signatures')
+    parser.add_argument('--cache-size', nargs=1, metavar='MB', type=int, help='Size limit of the signature cache in megabytes. Default: 4096')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the signature cache.')
+    parser.add_argument('--stream', action='store_true', help='Stream the products from FILE into compact per-product state instead of loading the whole file (detection only). Implied for .jsonl files. The words are then signed by their hash with seed 0 (see --token-seed). Not combined with --cache-dir and --cache-size, as no signatures are cached.')
+    parser.add_argument('--token-seed', nargs=1, metavar='SEED', type=int, help='Sign the words by their hash with SEED instead of by their position in the sorted vocabulary of FILE (detection only), as streaming does with SEED 0. With the same SEED, detection with and without --stream gives the same results.')
+    parser.add_argument('--benchmark', nargs='*', metavar='N', type=int, help='Benchmark the stages of detection on generated catalogs of N products (no FILE needed). Default: 1000 10000 100000 1000000')
+    parser.add_argument('--benchmark-baseline', nargs=1, metavar='RESULTS', type=str, help='Compare the benchmark to the results file of an earlier run.')
+    parser.add_argument('--build-index', nargs=1, metavar='INDEX', type=str, help='Build an LSH index of the products in FILE for the lookup service and save it to INDEX (.npz).')
+    parser.add_argument('--serve', nargs=1, metavar='INDEX', type=str, help='Answer duplicate lookups using the LSH index in INDEX (no FILE needed), as JSON Lines on stdin/stdout or over HTTP with --port.')
+    parser.add_argument('--port', nargs=1, metavar='PORT', type=int, help='Serve lookups over HTTP on localhost:PORT instead of stdin/stdout.')
+    parser.add_argument('--metrics', nargs=1, metavar='FILE', type=str, help='Write the timings, peak memory, candidate counts and bucket size histograms of the detection stages to FILE as JSON.')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print the progress of the detection stages.')
     parser.add_argument('-s', '--sim', nargs=1, metavar='SIM', type=float, help='Threshold similarity for classifying as duplicate. Default: 0.999')
     args = parser.parse_args()
 
+    workers = args.workers[0] if args.workers else 1
+
+    import cache
+    if args.cache_size:
+        cache.CACHE_SIZE = args.cache_size[0] * 2**20
+    cache_dir = None if args.no_cache else (args.cache_dir[0] if args.cache_dir else cache.CACHE_DIR)
+
+    if args.benchmark is not None:
+        from benchmark import benchmark, compare_benchmarks, SIZES
+        kwargs = {'compare_similarity': args.sim[0]} if args.sim else {}
+        if args.lsh_sim:
+            kwargs['lsh_similarity'] = args.lsh_sim[0]
+        print('Benchmarking the detection stages on generated catalogs')
+        report = benchmark(sizes=args.benchmark or SIZES, scheme=args.scheme, candidate_method=args.candidates, blocking=args.blocking, bits=args.bits, workers=workers, **kwargs)
+        if args.benchmark_baseline:
+            compare_benchmarks(args.benchmark_baseline[0], report)
+        return
+
+    if args.serve:
+        from serve import serve
+        serve(args.serve[0], args.port[0] if args.port else None)
+        return
+
+    if args.file is None:
+        parser.error('the following arguments are required: FILE')
+    from metrics import Metrics
+    metrics = Metrics(quiet=args.quiet, memory=args.metrics is not None)
     if args.file != None:
-        validate_file(args.file[0])
+        validate_file(args.file)
+        if args.build_index:
+            from serve import build_index
+            kwargs = {'compare_similarity': args.sim[0]} if args.sim else {}
+            if args.lsh_sim:
+                kwargs['lsh_similarity'] = args.lsh_sim[0]
+            index = build_index(args.file, args.build_index[0], scheme=args.scheme, **kwargs)
+            print('Saved the LSH index of {} products to: {}'.format(len(index), args.build_index[0]))
+            return
+        stream = args.stream or args.file.endswith('.jsonl')
+        if stream and not (args.train or args.test or args.compare_schemes):
+            if args.cache_dir or args.cache_size:
+                parser.error('--cache-dir and --cache-size cannot be used with --stream, which does not cache signatures')
+            from detect import detect_stream
+            kwargs = {'compare_similarity': args.sim[0]} if args.sim else {}
+            if args.lsh_sim:
+                kwargs['lsh_similarity'] = args.lsh_sim[0]
+            if args.token_seed:
+                kwargs['token_seed'] = args.token_seed[0]
+            print('Performing streaming duplicate detection on file: ' + args.file)
+            performance = detect_stream(args.file, scheme=args.scheme, metrics=metrics, candidate_method=args.candidates, blocking=args.blocking, bits=args.bits, workers=workers, **kwargs)
+            write_metrics(args, metrics, performance)
+            return
         import json
-        data = json.load(open(args.file[0], 'r'))
+        data = json.load(open(args.file, 'r'))
         if args.train:
             from optimize import train
-            print('Training on bootstraps from: ' + args.file[0])
-            train(data)
+            print('Training on bootstraps from: ' + args.file)
+            train(data, scheme=args.scheme, workers=workers, cache_dir=cache_dir, quiet=args.quiet, search=args.search)
+        elif args.compare_schemes:
+            from optimize import compare_schemes
+            print('Comparing signature schemes on bootstraps from: ' + args.file)
+            compare_schemes(data, cache_dir=cache_dir)
         elif args.test:
             from optimize import test
-            print('Testing on out-of-bag sample from: ' + args.file[0])
-            test(data, None, load_from_dir=args.test[0])
+            print('Testing on out-of-bag sample from: ' + args.file)
+            test(data, None, load_from_dir=args.test[0], scheme=args.scheme, workers=workers, cache_dir=cache_dir, quiet=args.quiet)
         else:
             from detect import detect
-            kwargs = {'desired_similarity': args.sim[0]} if args.sim else {}
+            kwargs = {'compare_similarity': args.sim[0]} if args.sim else {}
+            kwargs['scheme'] = args.scheme
+            kwargs['cache_dir'] = cache_dir
+            kwargs['candidate_method'] = args.candidates
+            kwargs['blocking'] = args.blocking
+            kwargs['bits'] = args.bits
+            kwargs['workers'] = workers
+            if args.token_seed:
+                kwargs['token_seed'] = args.token_seed[0]
             if args.lsh_sim:
                 kwargs['lsh_similarity'] = args.lsh_sim[0]
-            print('Performing duplicate detection on file: ' + args.file[0])
-            detect(data, **kwargs)
+            print('Performing duplicate detection on file: ' + args.file)
+            performance = detect(data, metrics=metrics, **kwargs)
+            write_metrics(args, metrics, performance)
     
 if __name__=='__main__':
     main()
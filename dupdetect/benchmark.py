@@ -0,0 +1,172 @@
+# Benchmarks of the stages of detect on synthetic catalogs
+#
+# A catalog of TV offers is generated with a given number of products and duplicate rate, after which every stage of
+# detect is measured (see metrics.Metrics): wall time, CPU time and peak memory (of the allocations traced by tracemalloc).
+# The results are written as JSON such that runs on different commits can be compared.
+import json
+import os
+import platform
+import random
+import subprocess
+
+import numpy as np
+
+from detect import detect
+from metrics import Metrics
+
+SIZES = (1000, 10000, 100000, 1000000)
+STAGES = ('preprocess', 'vocabulary', 'signatures', 'model_id_buckets', 'lsh_buckets', 'similarity_join', 'candidates', 'classify', 'evaluate')
+
+BRANDS = {'Samsung': 'UN', 'LG': 'LN', 'Sony': 'KDL-', 'Sharp': 'LC-', 'Toshiba': 'TL', 'Vizio': 'E', 'Panasonic': 'TCP', 'Philips': 'PFL', 'Coby': 'LEDTV', 'Haier': 'LE'}
+SHOPS = ('amazon.com', 'newegg.com', 'bestbuy.com', 'thenerds.net')
+SIZES_INCH = (19, 22, 24, 26, 29, 32, 37, 39, 40, 42, 46, 47, 50, 55, 60, 65, 70, 80)
+TITLE_WORDS = ('LED', 'LCD', 'Plasma', 'HDTV', 'Smart', '3D', 'Slim', 'Ultra', 'Class', 'Widescreen', 'Black', 'WiFi', 'Internet', 'Refurbished', '1080p', '720p', '4K')
+FEATURES = {'Refresh Rate': ('60Hz', '120Hz', '240Hz', '600Hz'), 'Aspect Ratio': ('16:9', '4:3'), 'Maximum Resolution': ('1920 x 1080', '1366 x 768', '3840 x 2160'),
+            'HDMI Inputs': ('1', '2', '3', '4'), 'Color': ('Black', 'Silver', 'White'), 'V-Chip': ('Yes', 'No'), 'USB Port': ('Yes', 'No')}
+
+
+def generate_model_id(rng, brand, size):
+    """
+    A modelID in the style of brand that is recognized by model_ids.model_id_regex, such as UN46ES6500 or LC-60LE650U.
+    """
+    series = ''.join(rng.choice('ABCDEFGHJKLMNPRSTUVW') for _ in range(rng.randint(1, 2)))
+    return '{}{}{}{}{}'.format(BRANDS[brand], size, series, rng.randint(100, 99999), rng.choice(('', '', 'U', 'X', 'A')))
+
+def generate_offer(rng, model, shop):
+    """
+    An offer of model by shop in the product format, with a title and featuresMap in the style of the shop.
+    """
+    brand, size, model_id, words, features = model
+    title = [brand, '{}"'.format(size)] + list(words)
+    rng.shuffle(title)
+    if rng.random() < 0.8:
+        title.insert(rng.randint(0, len(title)), model_id)
+    title.append(rng.choice(('', '- ' + shop, 'TV', '({} Model)'.format(rng.randint(2010, 2013)))))
+    featuresMap = {('Brand Name' if shop == 'newegg.com' else 'Brand'): brand, 'Screen Size': '{} inches'.format(size)}
+    featuresMap.update({k: v for k, v in features.items() if rng.random() < 0.7})
+    return {'shop': shop, 'url': 'https://www.{}/product/{}'.format(shop, model_id), 'modelID': model_id,
+            'featuresMap': featuresMap, 'title': ' '.join(word for word in title if word)}
+
+def generate_catalog(num_products, duplicate_rate=0.5, seed=0):
+    """
+    Generate a synthetic catalog of num_products TV offers in the modelID-keyed data format.
+    Every product is an offer of a new model or, with probability duplicate_rate, another offer of an existing model
+    by a shop that does not offer it yet. The catalog only depends on the arguments.
+    """
+    rng = random.Random(seed)
+    models, offers = [], []
+    open_models = []  # Models that are not offered by every shop yet
+    model_ids = set()
+    for _ in range(num_products):
+        if open_models and rng.random() < duplicate_rate:
+            k = rng.randrange(len(open_models))
+            m = open_models[k]
+        else:
+            brand, size = rng.choice(list(BRANDS)), rng.choice(SIZES_INCH)
+            model_id = generate_model_id(rng, brand, size)
+            while model_id in model_ids:
+                model_id = generate_model_id(rng, brand, size)
+            model_ids.add(model_id)
+            features = {k: rng.choice(values) for k, values in FEATURES.items()}
+            models.append((brand, size, model_id, rng.sample(TITLE_WORDS, rng.randint(3, 6)), features))
+            offers.append([])
+            m = len(models) - 1
+            k = len(open_models)
+            open_models.append(m)
+        shop = rng.choice([shop for shop in SHOPS if shop not in {offer['shop'] for offer in offers[m]}])
+        offers[m].append(generate_offer(rng, models[m], shop))
+        if len(offers[m]) == len(SHOPS):
+            open_models[k] = open_models[-1]
+            open_models.pop()
+    return {models[m][2]: offers[m] for m in range(len(models))}
+
+
+def run_stages(data, compare_similarity=0.999, lsh_similarity=0.999, scheme='minhash', candidate_method='lsh', blocking=False, bits=None, workers=1, trace=False):
+    """
+    Run detect on data without the signature cache, measuring wall time, CPU time and (if trace) the peak allocation of every stage (see metrics.Metrics).
+    Only the stages of the candidate_method are run (lsh_buckets or similarity_join), with blocking, b-bit signatures and workers if given (see detect).
+    Returns the measurements per stage, the counts (with the F1, PC and PQ) and the histograms of the bucket sizes.
+    """
+    metrics = Metrics(quiet=True, memory=trace)
+    performance = detect(data, compare_similarity, lsh_similarity, scheme=scheme, cache_dir=None, metrics=metrics, candidate_method=candidate_method, blocking=blocking, bits=bits, workers=workers)
+    return metrics.stages, {**metrics.counts, **{k: performance[k] for k in ('F1', 'PC', 'PQ')}}, metrics.histograms
+
+
+def scaling_exponents(results, key='wall'):
+    """
+    Estimate for every stage the exponent k of the scaling curve key ~ num_products^k, the slope of a least squares fit on log-log scale.
+    """
+    sizes = [res['counts']['num_products'] for res in results]
+    exponents = {}
+    for name in STAGES:
+        if any(name not in res['stages'] for res in results):
+            continue
+        values = [res['stages'][name][key] for res in results]
+        if len(sizes) >= 2 and min(values) > 0:
+            exponents[name] = float(np.polyfit(np.log(sizes), np.log(values), 1)[0])
+    return exponents
+
+def commit():
+    """
+    The git commit of the working tree, or None outside a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(sizes=SIZES, duplicate_rate=0.5, seed=0, memory=True, output=None, **kwargs):
+    """
+    Benchmark the stages of detect on generated catalogs of the given sizes. Times are measured without tracing;
+    with memory, every size is run a second time with tracemalloc to measure the peak memory per stage.
+    Other keyword arguments (compare_similarity, lsh_similarity, scheme, candidate_method, blocking, bits, workers) are passed to run_stages.
+    Writes the results to output (default results/benchmark-COMMIT.json) and returns them.
+    """
+    # Warm up, such that one-time costs (imports, first calls) do not count for the first size
+    run_stages(generate_catalog(100, duplicate_rate, seed), **kwargs)
+
+    results = []
+    for num_products in sizes:
+        data = generate_catalog(num_products, duplicate_rate, seed)
+        measurements, counts, histograms = run_stages(data, **kwargs)
+        if memory:
+            traced, _, _ = run_stages(data, trace=True, **kwargs)
+            for name in measurements:
+                measurements[name]['peak_memory'] = traced[name]['peak_memory']
+        results.append({'counts': counts, 'stages': measurements, 'histograms': histograms})
+        print('{:>8} products: '.format(num_products) + ' - '.join('{} {:.3f}s'.format(name, measurements[name]['wall']) for name in STAGES if name in measurements))
+
+    report = {'commit': commit(), 'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+              'settings': {'duplicate_rate': duplicate_rate, 'seed': seed, **kwargs}, 'results': results,
+              'scaling': scaling_exponents(results)}
+
+    print('Scaling exponents of the wall time: ' + ' - '.join('{} {:.2f}'.format(name, k) for name, k in report['scaling'].items()))
+    if output is None:
+        output = 'results/benchmark-{}.json'.format(report['commit'] or 'local')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    json.dump(report, open(output, 'w'), indent=1)
+    print('Benchmark results written to: ' + output)
+    return report
+
+def compare_benchmarks(baseline, report, key='wall'):
+    """
+    Print the ratio of key per stage and size between a report and a baseline report (or the file containing it).
+    Ratios below 1 mean the report is faster (or uses less memory) than the baseline.
+    """
+    if isinstance(baseline, str):
+        baseline = json.load(open(baseline, 'r'))
+    base = {res['counts']['num_products']: res['stages'] for res in baseline['results']}
+    print('Ratio of {} to baseline {}:'.format(key, baseline['commit']))
+    for res in report['results']:
+        n = res['counts']['num_products']
+        if n in base:
+            print('{:>8} products: '.format(n) + ' - '.join('{} {:.2f}'.format(name, res['stages'][name][key] / base[n][name][key])
+                                                           for name in STAGES if key in res['stages'].get(name, {}) and base[n].get(name, {}).get(key)))
+
+
+if __name__=='__main__':
+    data = generate_catalog(1000, seed=1)
+    mids = [product['modelID'].lower() for products in data.values() for product in products]
+    from model_ids import model_id_regex
+    print(len(data), 'models -', sum(1 for mid in mids if model_id_regex.match(mid)), 'of', len(mids), 'modelIDs match model_id_regex')
+    benchmark(sizes=(1000, 2000), memory=True, output='results/benchmark-example.json')
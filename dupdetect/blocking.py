@@ -0,0 +1,80 @@
+# Blocking of candidate pairs by shop and brand
+#
+# Duplicates are offers of the same product by different shops, so pairs of products of the same shop need not be
+# compared, and neither do regular candidates with conflicting brands, which compare.is_duplicate rejects anyway.
+# Blocking works on the buckets before they are expanded to pairs: the products of every bucket are ordered by shop and
+# only pairs across the shops of a bucket are formed, so same-shop pairs are never materialized.
+import numpy as np
+
+from compare import brand_conflicts
+from lsh import bucket_chunks, bucket_sizes, union_runs
+from tokens import Codes
+
+
+def shop_codes(flat_products):
+    """
+    Integer code of the (lowercase) shop of every product.
+    """
+    codes = Codes()
+    return np.array([codes(product['shop']) for product in flat_products], dtype=np.int64)
+
+
+def blocked_bucket_pairs(products, starts, num_products, shops, brands=None, chunk_size=2**22):
+    """
+    Generate the pairs of products that share a bucket (see lsh.bucket_pairs) and are offered by different shops, and if
+    brands (see compare.brand_codes) are given, do not have conflicting brands.
+    The buckets of a chunk (see lsh.bucket_chunks) are handled at once: within a bucket, every product is paired with the
+    products after its shop group, and the pairs of the chunks are merged as they come (see lsh.union_runs).
+    Returns the sorted unique pair keys and the blocking statistics: the number of pairs in the buckets, the number of
+    same-shop pairs and brand conflicts that were dropped (all counted with repetitions across buckets) and the number
+    of buckets of at least 2 products of a single shop, which are dropped as a whole.
+    """
+    all_sizes = bucket_sizes(products, starts)
+    stats = {'bucket_pairs': 0, 'same_shop_pairs': 0, 'single_shop_buckets': 0, 'brand_conflicts': 0}
+
+    def chunk_pairs(first_bucket, stop_bucket):
+        sizes = all_sizes[first_bucket:stop_bucket]
+        offset = starts[first_bucket]
+        chunk_starts = starts[first_bucket:stop_bucket] - offset
+        bucket = np.repeat(np.arange(len(sizes)), sizes)
+        chunk = products[offset:offset + sizes.sum()]
+        order = np.lexsort((shops[chunk], bucket))
+        chunk, bucket = chunk[order], bucket[order]
+        shop = shops[chunk]
+
+        # Ends of the group of the shop and of the bucket of every position
+        new_group = np.ones(len(chunk), dtype=bool)
+        new_group[1:] = (bucket[1:] != bucket[:-1]) | (shop[1:] != shop[:-1])
+        group_starts = np.flatnonzero(new_group)
+        group_sizes = np.diff(np.append(group_starts, len(chunk)))
+        group_end = np.repeat(group_starts + group_sizes, group_sizes)
+        bucket_end = np.repeat(chunk_starts + sizes, sizes)
+
+        # Pair every position with the positions from the end of its shop group to the end of its bucket
+        counts = bucket_end - group_end
+        first = np.repeat(np.arange(len(chunk)), counts)
+        second = np.repeat(group_end, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        i, j = chunk[first], chunk[second]
+        stats['bucket_pairs'] += int((sizes * (sizes - 1) // 2).sum())
+        stats['same_shop_pairs'] += int((group_sizes * (group_sizes - 1) // 2).sum())
+        stats['single_shop_buckets'] += int(((sizes >= 2) & (np.bincount(bucket[group_starts], minlength=len(sizes)) == 1)).sum())
+        if brands is not None:
+            conflict = brand_conflicts(brands, i, j)
+            stats['brand_conflicts'] += int(conflict.sum())
+            i, j = i[~conflict], j[~conflict]
+        return np.unique(np.minimum(i, j) * num_products + np.maximum(i, j))
+
+    pair_keys = union_runs((chunk_pairs(start, stop) for start, stop in bucket_chunks(all_sizes, chunk_size)), chunk_size)
+    return pair_keys, stats
+
+
+def block_pairs(pair_keys, num_products, shops, brands=None):
+    """
+    Drop the same-shop pairs and (if brands are given) the pairs with conflicting brands from pair keys, such as those
+    of a similarity join. Returns the remaining pair keys and the statistics of blocked_bucket_pairs.
+    """
+    i, j = np.divmod(pair_keys, num_products)
+    same_shop = shops[i] == shops[j]
+    conflict = brand_conflicts(brands, i, j) & ~same_shop if brands is not None else np.zeros(len(pair_keys), dtype=bool)
+    stats = {'bucket_pairs': len(pair_keys), 'same_shop_pairs': int(same_shop.sum()), 'single_shop_buckets': 0, 'brand_conflicts': int(conflict.sum())}
+    return pair_keys[~(same_shop | conflict)], stats
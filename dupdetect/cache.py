@@ -0,0 +1,92 @@
+# Persistent cache of signature matrices
+#
+# Entries are addressed by a hash of the products (in order, as they determine the columns) and the signature parameters,
+# and stored as .npy files which are memory-mapped when loaded. The least recently used entries are evicted
+# when the total size exceeds the size limit.
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_DIR = 'cache/signatures'  # Default of the command line; in Python the cache is only used with a cache_dir
+CACHE_SIZE = 2**32  # 4 GiB
+# Version of the preprocessing and signature encoding, part of every key: increase it when either changes, such that
+# entries computed by older code are no longer found (they are evicted in time)
+CACHE_VERSION = 1
+
+
+def signature_key(data, indices=None, **params):
+    """
+    Obtain the content address of the signatures of data, a hash of CACHE_VERSION, the products and the signature parameters.
+    With indices, the signatures are those of the products at these indices into the flattened products of data.
+    """
+    h = hashlib.sha256()
+    h.update('version {}\n'.format(CACHE_VERSION).encode())
+    for chunk in json.JSONEncoder().iterencode(data):
+        h.update(chunk.encode())
+    if indices is not None:
+        h.update(np.asarray(indices, dtype=np.int64).tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+def cache_file(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, key + '.npy')
+
+def load(key, cache_dir=CACHE_DIR):
+    """
+    Memory-map the cached signatures for key, or return None if they are not in the cache.
+    """
+    f = cache_file(key, cache_dir)
+    if not os.path.exists(f):
+        return None
+    os.utime(f)  # Mark as recently used
+    return np.load(f, mmap_mode='r')
+
+def store(key, signatures, cache_dir=CACHE_DIR, max_size=None):
+    """
+    Store the signatures for key and evict entries to stay within max_size bytes (default CACHE_SIZE).
+    The file is written under a temporary name first, such that concurrent readers never see a partial entry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    f = cache_file(key, cache_dir)
+    tmp = '{}.{}.tmp'.format(f, os.getpid())
+    with open(tmp, 'wb') as fp:
+        np.save(fp, signatures)
+    os.replace(tmp, f)
+    evict(cache_dir, max_size)
+
+def evict(cache_dir=CACHE_DIR, max_size=None):
+    """
+    Remove the least recently used entries until the cache holds at most max_size bytes (default CACHE_SIZE).
+    """
+    if max_size is None:
+        max_size = CACHE_SIZE
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npy'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+
+def cached_signatures(data, compute, cache_dir=None, max_size=None, indices=None, **params):
+    """
+    Look up the signatures of data (or of the products at indices, see signature_key) for the given signature parameters
+    in the cache, or compute() and store them. The result is memory-mapped from the cache when possible. With cache_dir None the cache is not used.
+    """
+    if cache_dir is None:
+        return compute()
+    key = signature_key(data, indices, **params)
+    signatures = load(key, cache_dir)
+    if signatures is None:
+        signatures = compute()
+        store(key, signatures, cache_dir, max_size)
+        stored = load(key, cache_dir)  # Unless it was evicted right away
+        if stored is not None:
+            signatures = stored
+    return signatures
@@ -1,4 +1,8 @@
+import numpy as np
+
+from minhashing import PackedSignatures
 from preprocessing import get_words
+from tokens import intern_sets
 
 
 def is_duplicate(product1, product2, signature1, signature2, threshold, similarity, check_brand=True):
@@ -17,4 +21,61 @@ def classify(flat_products, candidates, signatures, *args, **kwargs):
         pred_dupe = is_duplicate(flat_products[p1[1]], flat_products[p2[1]], signatures[:, p1[1]], signatures[:, p2[1]], *args, **kwargs)[0]
         # real_dupe = is_real_duplicate(flat_products[p1[1]], flat_products[p2[1]])
 
-        yield (p1[1], p2[1], pred_dupe)
\ No newline at end of file
+        yield (p1[1], p2[1], pred_dupe)
+
+def brand_codes(flat_products):
+    """
+    Integer code of the (lowercase) brand of every product, -1 for products without a brand.
+    """
+    codes = {}
+    return np.array([codes.setdefault(product['brand'].lower(), len(codes)) if 'brand' in product else -1 for product in flat_products], dtype=np.int64)
+
+
+def brand_conflicts(brands, i1, i2):
+    """
+    Whether the brands of the pairs (i1, i2) are both known and different, given the brand codes.
+    """
+    return (brands[i1] >= 0) & (brands[i2] >= 0) & (brands[i1] != brands[i2])
+
+
+def signature_agreement(signatures, i1, i2, chunk_size=2**22):
+    """
+    Fraction of equal signature values of every pair (i1, i2), in chunks of about chunk_size compared values.
+    For minhashing.PackedSignatures, this is the corrected estimate of PackedSignatures.agreement.
+    """
+    agreement = np.empty(len(i1))
+    step = max(1, chunk_size // signatures.shape[0])
+    for start in range(0, len(i1), step):
+        chunk = slice(start, start + step)
+        if isinstance(signatures, PackedSignatures):
+            agreement[chunk] = signatures.agreement(i1[chunk], i2[chunk])
+        else:
+            agreement[chunk] = (signatures[:, i1[chunk]] == signatures[:, i2[chunk]]).mean(axis=0)
+    return agreement
+
+
+def compare_sets(flat_products, tokens=None):
+    """
+    The word sets (see get_words) of the flattened products that are compared, as tokens.TokenSets interned with tokens
+    (such as the tokens of the product word sets, a new tokens.Codes by default).
+    """
+    return intern_sets((get_words(product) for product in flat_products), tokens)
+
+
+def classify_pairs(i1, i2, signatures, brands, words, threshold, similarity, check_brand=True):
+    """
+    Classify all candidate pairs (i1, i2) at once, with the same outcome as is_duplicate for every pair.
+    :param brands: The brand codes of the products (see brand_codes)
+    :param words: The compared word sets of the products as tokens.TokenSets (see compare_sets)
+    :param similarity: Function giving the similarity of the word sets of all pairs (words, i1, i2), such as similarity.jaccard_pairs
+    The signature agreement of all pairs is computed with one vectorized operation and the similarity only for the pairs
+    with agreement below the threshold and no brand conflict, also at once. Returns a boolean array of predictions.
+    """
+    pred = signature_agreement(signatures, i1, i2) >= threshold
+    undecided = ~pred
+    if check_brand:
+        conflict = brand_conflicts(brands, i1, i2)
+        pred &= ~conflict
+        undecided &= ~conflict
+    pred[undecided] = similarity(words, i1[undecided], i2[undecided]) > threshold
+    return pred
@@ -1,120 +1,366 @@
 # Python native imports
 import json
-from itertools import combinations
+
+import numpy as np
 
 # Internal package imports
 from preprocessing import clean, clean_line, get_words
-from model_ids import extract_model_ids
 
-from minhashing import best_bands, isprime, generate_minhash_funcs, make_signatures
+from minhashing import PackedSignatures, best_bands, forest_bands, isprime, compute_signatures, pack_signatures, precompute_signatures
+from cache import cached_signatures
 
-from similarity import jaccard
+from similarity import jaccard_pairs
+from tokens import intern_sets
 
-from lsh import add_to_buckets, lsh, model_buckets
-from compare import classify
-from evaluate import plot_confusion, confusion_matrix, grade_classification, evaluate, pair_performance
+from join import similarity_join
+from blocking import block_pairs, blocked_bucket_pairs, shop_codes
+from lsh import LSHForest, band_buckets, bucket_pairs, bucket_sizes, group, model_id_buckets
+from compare import brand_codes, compare_sets, classify_pairs
+from evaluate import plot_confusion, count_real_duplicates, evaluate, grade, model_id_codes
+from metrics import Metrics
+from parallel import band_pairs
 
 def detect_from_file(file, *args, **kwargs):
     data = json.load(open(file, 'r'))
     return detect(data, *args, **kwargs)
 
 
-def detect(data, compare_similarity=0.999, lsh_similarity=0.999, num_const = 105, num_mult = 11, pre_comp_signature=None):
-
-    modelIDs = list(data.keys())
-
-    products = [product for products in list(data.values()) for product in products]
-    
-    flat_products = [{**{clean(k).replace('brand name', 'brand'): clean_line(v) for k, v in product['featuresMap'].items()}, 
+def flat_product(product):
+    """
+    Flatten a product to a dictionary of its cleaned features, title, shop, url and modelID (None if unknown).
+    """
+    return {**{clean(k).replace('brand name', 'brand'): clean_line(v) for k, v in product['featuresMap'].items()}, 
                 'title': clean_line(product['title']),
                 'shop': product['shop'].lower(),
                 'url': product['url'],
-                'modelID': product['modelID'] if 'modelID' in product else None} for product in products]
+                'modelID': product['modelID'] if 'modelID' in product else None}
+
+
+def product_table(data, indices=None):
+    """
+    Flatten the products of data (or only those at the given indices into the flattened products) and clean them.
+    Returns (products, flat_products, product_sets, words, groups) where product_sets holds the word sets of the products
+    and words the word sets that are compared (see compare.compare_sets), both as tokens.TokenSets with the same tokens,
+    and groups the code of the modelID key of every product. The word sets are computed only once, here.
+    """
+    products = [product for products in list(data.values()) for product in products]
+    groups = np.repeat(np.arange(len(data)), [len(same_prods) for same_prods in data.values()])
+    if indices is not None:
+        products = [products[k] for k in indices]
+        groups = groups[indices]
+
+    flat_products = [flat_product(product) for product in products]
+
+    # Obtain the feature matrix (in a sparse way) Every product has a set of token ids of the words of all products.
+    product_sets = intern_sets(get_words(product) for product in products)
+    words = compare_sets(flat_products, product_sets.tokens)
+
+    return products, flat_products, product_sets, words, groups
+
+
+def select(table, indices):
+    """
+    Select the products at the given indices from a product table (see product_table), without copying them.
+    """
+    products, flat_products, product_sets, words, groups = table
+    return [products[k] for k in indices], [flat_products[k] for k in indices], product_sets.select(indices), words.select(indices), groups[indices]
+
+
+def prepare(data, num_const=105, num_mult=11, pre_comp_signature=None, scheme='minhash', token_seed=None, cache_dir=None, indices=None, table=None, metrics=None, bits=None):
+    """
+    Perform the stages of detect that do not depend on the similarity thresholds: flattening and cleaning the products,
+    obtaining the data statistics and word sets and computing the signatures (or loading them from the cache in cache_dir, if given).
+    With indices, only the products at these indices into the flattened products of data are used (as a bootstrap does),
+    taken from table (see product_table) if it is given. pre_comp_signature then holds the columns of these products only.
+    With bits, only the lowest bits of every signature value are kept (b-bit minwise hashing, see minhashing.PackedSignatures).
+    The stages are measured in metrics (see metrics.Metrics).
+    Returns (flat_products, product_sets, words, data_stats, signatures), see product_table.
+    """
+    metrics = metrics or Metrics()
+    with metrics.stage('preprocess'):
+        if table is None:
+            table = product_table(data, indices)
+        elif indices is not None:
+            table = select(table, indices)
+    products, flat_products, product_sets, words, groups = table
 
     # Obtain data statistics
-    # Obtain number of duplicates per modelID
     num_products = len(flat_products)
 
-    real_duplicate_pairs = [(product1, product2) for modelID, same_prods in data.items() for product1, product2 in combinations(same_prods, 2)]
-
-    data_stats = {'n': num_products, 'Nd': len(real_duplicate_pairs)}
-    print("Data statistics: ", data_stats)
+    # The number of real duplicate pairs follows from the group sizes
+    data_stats = {'n': num_products, 'Nd': count_real_duplicates(groups)}
+    metrics.log("Data statistics: ", data_stats)
+    metrics.count('num_products', num_products)
+    metrics.count('num_real_duplicates', data_stats['Nd'])
 
     # Obtain all words in every product
-    all_words = sorted({word for product in products for word in get_words(product)})
-
-    # Obtain the feature matrix (in a sparse way) Every product has a set of words from the all words set.
-    product_sets = [get_words(product) for product in products]
-
-    # Find the best values of r and b given n
-    n = 3*5*7*11  # Number of minhash functions (1155)
+    with metrics.stage('vocabulary'):
+        num_words = len(np.unique(product_sets.ids))
+    metrics.count('num_words', num_words)
+    metrics.count('token_bytes', product_sets.nbytes)
 
-    (r, b, threshold) = best_bands(lsh_similarity, n)
-    print('r: {} - b: {} - threshold: {}'.format(r, b, threshold))
+    n = num_const*num_mult  # Number of minhash functions (1155)
 
     # Minhash functions 
     R = 2*3*5*7*11*13*17+19
 
-    print('Using modulus for minhash functions: R = {}, R is prime: {}'.format(R, isprime(R)))
-
-    # Generate the actual minhash functions given the bands and row
-    print('Using {} multipliers and {} shifts'.format(num_mult, num_const))
-    hash_funcs = list(generate_minhash_funcs(num_const, num_mult, R))
+    metrics.log('Using modulus for minhash functions: R = {}, R is prime: {}'.format(R, isprime(R)))
 
     if pre_comp_signature is None:
-        signatures = make_signatures(all_words, product_sets, hash_funcs, len(hash_funcs), R)
+        if scheme == 'oph':
+            metrics.log('Using one-permutation hashing with {} bins'.format(n))
+        else:
+            # Generate the actual minhash functions given the bands and row
+            metrics.log('Using {} multipliers and {} shifts'.format(num_mult, num_const))
+        with metrics.stage('signatures'):
+            if indices is not None and token_seed is not None and cache_dir is not None:
+                # The columns of the signatures of all products, which the cache shares between all subsets of data
+                signatures = precompute_signatures(data, num_const, num_mult, R, scheme, token_seed, cache_dir, indices=indices, bits=bits)
+            else:
+                if bits is None:
+                    compute = lambda: compute_signatures(product_sets, num_const, num_mult, R, scheme, token_seed)
+                else:
+                    compute = lambda: pack_signatures(compute_signatures(product_sets, num_const, num_mult, R, scheme, token_seed), bits)
+                signatures = cached_signatures(data, compute, cache_dir, indices=indices, num_const=num_const, num_mult=num_mult, R=R, scheme=scheme, token_seed=token_seed, bits=bits)
+            if bits is not None:
+                signatures = PackedSignatures(signatures, bits, n)
+    elif bits is not None:
+        signatures = PackedSignatures(pack_signatures(pre_comp_signature, bits), bits, n)
     else:
         signatures = pre_comp_signature
-    
-
-    # Perform the LSH-ing
-    buckets = {}
-    mid_buckets = {}
-    for index in range(signatures.shape[1]): # For all signatures (which are columns in the signature matrix)
-        sgn = signatures[:, index]
-        product_set = product_sets[index]
-
-        add_to_buckets(mid_buckets, sgn, index, model_buckets(product_set))
-        add_to_buckets(buckets, sgn, index, lsh(sgn, r=r, b=b))
-    
-    # Discard all buckets with less than 2 entities
-    # bucket_sizes = [len(b_prods) for k, b_prods in buckets.items()]
-    filled_buckets = {k: b_prod for k, b_prod in buckets.items() if len(b_prod) >= 2}
+    metrics.count('signature_bytes', signatures.nbytes)
 
-    # mid_bucket_sizes = [[len(b_prods) for k, b_prods in mid_buckets.items()]]
-    mid_filled_buckets = {k: b_prod for k, b_prod in mid_buckets.items() if len(b_prod) >= 2}
+    return flat_products, product_sets, words, data_stats, signatures
 
-    print('Reduced amount of buckets from {} to {}'.format(len(buckets), len(filled_buckets)))
-    print('Reduced amount of model ID buckets from {} to {}'.format(len(mid_buckets), len(mid_filled_buckets)))
 
+def model_id_candidates(product_sets, metrics=None, shops=None):
+    """
+    Generate the candidate pairs of products sharing a model ID bucket, as pair keys i * num_products + j.
+    With the shop codes shops (see blocking.shop_codes), only pairs of products of different shops are generated.
+    """
+    metrics = metrics or Metrics()
+    with metrics.stage('model_id_buckets'):
+        mid_products, mid_starts = model_id_buckets(product_sets)
+    return bucket_candidates(mid_products, mid_starts, len(product_sets), 'model_id', metrics, shops)
 
-    # Generate candidates from all buckets
-    
-    mid_candidates = {(p1, p2) for k in mid_filled_buckets.keys() for p1, p2 in combinations(mid_filled_buckets[k], 2)} # p1 = (signature, index), p2 = (signature, index)
-    print('Number of model ID candidates: {}'.format(len(mid_candidates)))
-    candidates = {(p1, p2) for k, b_prods in filled_buckets.items() for p1, p2 in combinations(b_prods,2) if (p1, p2) not in mid_candidates}
-    len(candidates)
-    print('Number of regular candidates: {}'.format(len(candidates)))
 
-    print('Using Jaccard similarity with threshold: {}'.format(compare_similarity))
-    # Classify everything and compute performance measures
-    classification = [*classify(flat_products, candidates, signatures, compare_similarity, jaccard), *classify(flat_products, mid_candidates, signatures, 0.0, jaccard, check_brand=False)]
-    # classification = [*classify(flat_products, candidates, signatures, 0.6, jaccard, check_brand=False)]
+def bucket_candidates(products, starts, num_products, kind, metrics, shops=None, brands=None):
+    """
+    Generate the candidate pairs of the buckets (products, starts) of the given kind ('model_id' or 'lsh'), recording the bucket sizes in metrics.
+    With shops (and brands), the buckets are blocked by shop (and brand), see blocking.blocked_bucket_pairs.
+    """
+    sizes = bucket_sizes(products, starts)
+    metrics.histogram(kind + '_bucket_sizes', sizes)
 
-    graded_classification = list(grade_classification(flat_products, classification))
-
-    conf_mat = confusion_matrix(graded_classification, data_stats['Nd'], data_stats['n'])
-    print() # Print newline
-    plot_confusion(conf_mat, data_stats['Nd'], data_stats['n'])
-    # Correctly compute pair performance
-    pair_perf = pair_performance(graded_classification, data_stats['Nd'])
+    # Discard all buckets with less than 2 entities
+    filled_buckets = (sizes >= 2).sum()
+    metrics.log('Reduced amount of {}buckets from {} to {}'.format('model ID ' if kind == 'model_id' else '', len(starts), filled_buckets))
+    with metrics.stage('candidates'):
+        if shops is None:
+            return bucket_pairs(products, starts, num_products)
+        candidates, stats = blocked_bucket_pairs(products, starts, num_products, shops, brands)
+    record_blocking(kind, stats, metrics)
+    return candidates
+
+
+def record_blocking(kind, stats, metrics):
+    """
+    Log and count the blocking statistics (see blocking.blocked_bucket_pairs) of the candidates of the given kind.
+    """
+    metrics.log('Blocking of {} pairs: dropped {} same-shop pairs ({} single-shop buckets) and {} brand conflicts'.format(
+        kind, stats['same_shop_pairs'], stats['single_shop_buckets'], stats['brand_conflicts']))
+    for name, value in stats.items():
+        metrics.count('{}_{}'.format(kind, name), value)
+
+
+def lsh_candidates(signatures, r, b, mid_candidates, metrics=None, shops=None, brands=None, forest=False, workers=1):
+    """
+    Generate the candidate pairs of products sharing an LSH bucket that are not model ID candidates, as pair keys i * num_products + j.
+    With forest, the buckets are those of prefix length r in b trees of an lsh.LSHForest, which allows any r with b <= n // r.
+    With shops (and brands), the buckets are blocked by shop (and brand), see blocking.blocked_bucket_pairs.
+    With more than 1 workers, the bands are sharded over worker processes (see parallel.band_pairs), which gives the same
+    candidates. The lsh_buckets stage then includes the generation of the pairs.
+    """
+    metrics = metrics or Metrics()
+    if workers > 1 and not forest:
+        with metrics.stage('lsh_buckets'):
+            candidates, frequencies, stats = band_pairs(signatures, r, b, workers, shops, brands)
+        metrics.histogram('lsh_bucket_sizes', np.repeat(np.arange(len(frequencies)), frequencies))
+        metrics.log('Reduced amount of buckets from {} to {}'.format(frequencies.sum(), frequencies[2:].sum()))
+        if stats is not None:
+            record_blocking('lsh', stats, metrics)
+        with metrics.stage('candidates'):
+            return np.setdiff1d(candidates, mid_candidates, assume_unique=True)
+    # Buckets are stored as product indices grouped by bucket: bucket k holds products[starts[k]:starts[k+1]]
+    with metrics.stage('lsh_buckets'):
+        if forest:
+            lsh_products, lsh_starts = LSHForest(signatures, r, b).buckets()
+        else:
+            lsh_products, lsh_starts = band_buckets(signatures, r=r, b=b)
+
+    candidates = bucket_candidates(lsh_products, lsh_starts, signatures.shape[1], 'lsh', metrics, shops, brands)
+    with metrics.stage('candidates'):
+        return np.setdiff1d(candidates, mid_candidates, assume_unique=True)
+
+
+def join_candidates(product_sets, words, threshold, mid_candidates, metrics=None, shops=None, brands=None):
+    """
+    Generate the pairs of products that are not model ID candidates and have a Jaccard similarity of at least threshold
+    between their word sets, as pair keys, with exact similarity joins (see join.similarity_join). Both the word sets that are
+    signed (product_sets) and the word sets that are compared (words, see compare.compare_sets) are joined,
+    as the classification accepts a pair on the signature agreement (an estimate of the former) or the similarity of the latter.
+    With shops (and brands), the pairs are blocked by shop (and brand), see blocking.block_pairs.
+    """
+    metrics = metrics or Metrics()
+    with metrics.stage('similarity_join'):
+        candidates = np.union1d(similarity_join(product_sets, threshold), similarity_join(words, threshold))
+    with metrics.stage('candidates'):
+        if shops is not None:
+            candidates, stats = block_pairs(candidates, len(product_sets), shops, brands)
+            record_blocking('join', stats, metrics)
+        return np.setdiff1d(candidates, mid_candidates, assume_unique=True)
+
+
+def detect(data, compare_similarity=0.999, lsh_similarity=0.999, num_const = 105, num_mult = 11, pre_comp_signature=None, scheme='minhash', token_seed=None, cache_dir=None, indices=None, table=None, metrics=None, candidate_method='lsh', blocking=False, bits=None, workers=1):
+    """
+    Detect the duplicates in data and evaluate the performance. With indices (and optionally table), only the
+    products at these indices into the flattened products of data are used, see prepare. bits selects b-bit signatures (see prepare).
+    The regular candidates are generated with LSH on the signatures (candidate_method 'lsh'), with an LSH forest, which
+    picks the prefix length for lsh_similarity from all lengths instead of the divisors of n ('forest', see lsh.LSHForest),
+    or with an exact similarity join of the word sets at compare_similarity ('join'), which finds every pair that the
+    Jaccard similarity classifies as duplicate.
+    With blocking, only products of different shops are compared, and regular candidates with conflicting brands are dropped
+    before classification (see blocking.py). With more than 1 workers, the LSH bands are sharded over worker processes.
+    The timings, candidate counts and bucket size histograms of the stages are recorded in metrics (see metrics.Metrics),
+    which also determines whether the progress is printed.
+    """
+    metrics = metrics or Metrics()
+    flat_products, product_sets, words, data_stats, signatures = prepare(data, num_const, num_mult, pre_comp_signature, scheme, token_seed, cache_dir, indices, table, metrics, bits)
+
+    shops = shop_codes(flat_products) if blocking else None
+
+    return detect_candidates(signatures, product_sets, brand_codes(flat_products), words, model_id_codes(flat_products), data_stats, compare_similarity, lsh_similarity, metrics, candidate_method=candidate_method, shops=shops, workers=workers)
+
+
+def detect_candidates(signatures, product_sets, brands, words, codes, data_stats, compare_similarity, lsh_similarity, metrics, mid_candidates=None, candidate_method='lsh', shops=None, workers=1):
+    """
+    Perform the stages of detect from the candidate generation on: generate the candidates, classify and evaluate them.
+    :param brands: The brand codes of the products (see compare.brand_codes)
+    :param words: The compared word sets of the products as tokens.TokenSets (see compare.compare_sets)
+    :param codes: The modelID codes of the products (see evaluate.model_id_codes)
+    :param mid_candidates: The model ID candidates if they are already known, otherwise they are generated from product_sets
+    :param candidate_method: 'lsh', 'forest' or 'join' (see detect)
+    :param shops: The shop codes of the products (see blocking.shop_codes) to block the candidates by shop and brand, None for no blocking
+    :param workers: The number of worker processes for the LSH bands (see lsh_candidates)
+    """
+    if candidate_method != 'join':
+        # Find the best values of r and b given n (the prefix length and number of trees of a forest)
+        n = signatures.shape[0]
+
+        (r, b, threshold) = forest_bands(lsh_similarity, n) if candidate_method == 'forest' else best_bands(lsh_similarity, n)
+        metrics.log('r: {} - b: {} - threshold: {}'.format(r, b, threshold))
+        metrics.count('r', r)
+        metrics.count('b', b)
+
+    # Generate candidates from all buckets, as pair keys i * num_products + j
+    if mid_candidates is None:
+        mid_candidates = model_id_candidates(product_sets, metrics, shops)
+    metrics.log('Number of model ID candidates: {}'.format(len(mid_candidates)))
+    metrics.count('model_id_candidates', len(mid_candidates))
+    if candidate_method == 'join':
+        metrics.log('Similarity join with threshold: {}'.format(compare_similarity))
+        candidates = join_candidates(product_sets, words, compare_similarity, mid_candidates, metrics, shops, brands)
+    else:
+        candidates = lsh_candidates(signatures, r, b, mid_candidates, metrics, shops, brands, forest=candidate_method == 'forest', workers=workers)
+    metrics.log('Number of regular candidates: {}'.format(len(candidates)))
+    metrics.count('regular_candidates', len(candidates))
 
+    metrics.log('Using Jaccard similarity with threshold: {}'.format(compare_similarity))
+    # Classify everything and compute performance measures
+    with metrics.stage('classify'):
+        classification = classify_candidates(candidates, mid_candidates, signatures, brands, words, compare_similarity)
+    metrics.count('predicted_duplicates', classification[2].sum())
+
+    with metrics.stage('evaluate'):
+        return report(codes, *classification, data_stats, metrics)
+
+
+def classify_candidates(candidates, mid_candidates, signatures, brands, words, compare_similarity):
+    """
+    Classify the regular candidates using compare_similarity and the model ID candidates using threshold 0.0 without brand check.
+    Returns the index arrays (i1, i2) and the predictions of all candidates.
+    """
+    num_products = signatures.shape[1]
+    classification = []
+    for pair_keys, threshold, check_brand in [(candidates, compare_similarity, True), (mid_candidates, 0.0, False)]:
+        i1, i2 = np.divmod(pair_keys, num_products)
+        pred = classify_pairs(i1, i2, signatures, brands, words, threshold, jaccard_pairs, check_brand=check_brand)
+        classification.append((i1, i2, pred))
+    return [np.concatenate(arrays) for arrays in zip(*classification)]
+
+
+def report(codes, i1, i2, pred, data_stats, metrics=None):
+    """
+    Evaluate the classified pairs against the modelID codes of the products and print the confusion matrix and performance.
+    """
+    metrics = metrics or Metrics()
+    conf_mat, pair_perf = grade(codes, i1, i2, pred, data_stats['Nd'], data_stats['n'])
+    if len(pred) == 0:
+        metrics.log('No candidate pairs left to compare (e.g. blocking on a catalog of a single shop)')
+    if not metrics.quiet:
+        print() # Print newline
+        plot_confusion(conf_mat, data_stats['Nd'], data_stats['n'])
 
     performance = evaluate(**conf_mat, **pair_perf, num_real_duplicates=data_stats['Nd'], num_products=data_stats['n'])
-    print('\n'.join(['{:>22}: {}'.format(k,v) for k, v in performance.items()]))
+    metrics.log('\n'.join(['{:>22}: {}'.format(k,v) for k, v in performance.items()]))
 
-    print('DONE')
+    metrics.log('DONE')
     return performance
 
+
+def detect_stream(file, compare_similarity=0.999, lsh_similarity=0.999, metrics=None, candidate_method='lsh', blocking=False, bits=None, workers=1, **kwargs):
+    """
+    Perform duplicate detection on a product file that is streamed into a compact catalog (see ingest.read_catalog),
+    such that memory is proportional to the signature matrix rather than the JSON. Other keyword arguments are passed to ingest.Catalog.
+    The words are always signed by their stable hash (token_seed 0 by default, see minhashing.token_hash), as the vocabulary
+    is not known in advance, so the result equals detect with the same token_seed rather than detect by default.
+    """
+    from ingest import read_catalog
+    metrics = metrics or Metrics()
+    with metrics.stage('ingest'):
+        catalog = read_catalog(file, **kwargs)
+    metrics.log('Signing with token seed: {}'.format(catalog.token_seed))
+    return detect_catalog(catalog, compare_similarity, lsh_similarity, metrics, candidate_method, blocking, bits, workers)
+
+
+def detect_catalog(catalog, compare_similarity=0.999, lsh_similarity=0.999, metrics=None, candidate_method='lsh', blocking=False, bits=None, workers=1):
+    """
+    Perform duplicate detection on an ingest.Catalog, using its compact state instead of the product dictionaries.
+    bits selects b-bit signatures, see prepare.
+    """
+    metrics = metrics or Metrics()
+    with metrics.stage('signatures'):
+        signatures = catalog.signatures
+        if bits is not None:
+            signatures = PackedSignatures(pack_signatures(signatures, bits), bits, len(signatures))
+    metrics.count('signature_bytes', signatures.nbytes)
+    num_products = catalog.num_products
+    model_id = catalog.arrays('model_id')
+
+    data_stats = {'n': num_products, 'Nd': count_real_duplicates(model_id)}
+    metrics.log("Data statistics: ", data_stats)
+    metrics.count('num_products', num_products)
+    metrics.count('num_real_duplicates', data_stats['Nd'])
+
+    # Model ID buckets from the model ID codes of the catalog
+    with metrics.stage('model_id_buckets'):
+        mid_indptr = catalog.arrays('mid_indptr')
+        mid_products, mid_starts = group(np.repeat(np.arange(num_products), np.diff(mid_indptr)), catalog.arrays('mid_ids'))
+    shops = catalog.arrays('shop') if blocking else None
+    mid_candidates = bucket_candidates(mid_products, mid_starts, num_products, 'model_id', metrics, shops)
+
+    return detect_candidates(signatures, catalog.token_sets(), catalog.arrays('brand'), catalog.token_sets(compare=True), model_id, data_stats, compare_similarity, lsh_similarity, metrics, mid_candidates, candidate_method, shops, workers)
+
+
 if __name__=='__main__':
     detect_from_file('data/data.json')
\ No newline at end of file
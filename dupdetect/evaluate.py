@@ -17,10 +17,10 @@ def is_real_duplicate(product1, product2):
 
 
 def real_labels(flat_products, candidates):
-    for p1, p2 in candidates:
-        real_dupe = is_real_duplicate(flat_products[p1[1]], flat_products[p2[1]])
+    for i1, i2 in candidates:
+        real_dupe = is_real_duplicate(flat_products[i1], flat_products[i2])
 
-        yield (p1[1], p2[1], real_dupe)
+        yield (i1, i2, real_dupe)
 
 def grade_classification(flat_products, classification):
     for i1, i2, pred in classification:
@@ -28,16 +28,23 @@ def grade_classification(flat_products, classification):
         yield (i1, i2, obs_type(pred, real_dupe))
 
 def confusion_matrix(graded_classification, num_real_duplicates, num_products):
-    confusion = {'TP': 0, 'FP': 0, 'TN': 0, 'FN': 0, 'unknown': 0, 'num_comparisons': len(graded_classification)}
-    total = num_products * (num_products-1) / 2
+    TP, FP, unknown = 0, 0, 0
     for p1, p2, c in graded_classification:
         if c == 'TP':
-            confusion['TP'] += 1
+            TP += 1
         elif c == 'FP':
-            confusion['FP'] += 1
+            FP += 1
         elif c == 'unknown':
-            confusion['unknown'] += 1
+            unknown += 1
     
+    return count_confusion(TP, FP, unknown, len(graded_classification), num_real_duplicates, num_products)
+
+def count_confusion(TP, FP, unknown, num_comparisons, num_real_duplicates, num_products):
+    """
+    Complete the confusion matrix from the counted TP, FP and unknown observations among the comparisons.
+    """
+    total = num_products * (num_products-1) / 2
+    confusion = {'TP': int(TP), 'FP': int(FP), 'TN': 0, 'FN': 0, 'unknown': int(unknown), 'num_comparisons': int(num_comparisons)}
     confusion['FN'] = int(num_real_duplicates - confusion['TP'])
     confusion['TN'] = int(total - num_real_duplicates - confusion['FP'])
     return confusion
@@ -48,6 +55,41 @@ def pair_performance(graded_classification, num_real_duplicates):
     return {'PQ': Df/num_comparisons, 'PC': Df/num_real_duplicates}
 
 
+def model_id_codes(flat_products):
+    """
+    Integer code of the modelID of every product, -1 if it is unknown (None).
+    """
+    codes = {}
+    return np.array([codes.setdefault(product['modelID'], len(codes)) if product['modelID'] is not None else -1 for product in flat_products], dtype=np.int64)
+
+def count_real_duplicates(codes):
+    """
+    Number of pairs of products with the same (known) modelID, from the group sizes of the modelID codes.
+    """
+    sizes = np.bincount(codes[codes >= 0])
+    return int((sizes * (sizes-1) // 2).sum())
+
+def grade_pairs(codes, i1, i2, pred):
+    """
+    Count the observations of the classified pairs (i1, i2) with predictions pred using boolean masks, like grade_classification.
+    Returns (TP, FP, unknown, Df) where Df is the number of TP and FN observations.
+    """
+    unknown = codes[i1] < 0
+    real = (codes[i1] == codes[i2]) & ~unknown
+    return int((pred & real).sum()), int((pred & ~real & ~unknown).sum()), int(unknown.sum()), int(real.sum())
+
+def grade(codes, i1, i2, pred, num_real_duplicates, num_products):
+    """
+    Obtain the confusion matrix and pair performance of the classified pairs, as confusion_matrix and pair_performance do for graded classifications.
+    """
+    TP, FP, unknown, Df = grade_pairs(codes, i1, i2, pred)
+    num_comparisons = len(pred)
+    confusion = count_confusion(TP, FP, unknown, num_comparisons, num_real_duplicates, num_products)
+    # blocking can leave no comparisons at all (e.g. a catalog of a single shop)
+    PQ = Df/num_comparisons if num_comparisons else 0
+    PC = Df/num_real_duplicates if num_real_duplicates else 0
+    return confusion, {'PQ': PQ, 'PC': PC}
+
 def plot_confusion(confusion, num_real_duplicates, num_products):
     t = num_products * (num_products-1) / 2
     print("""Confusion Matrix:
@@ -65,8 +107,9 @@ def evaluate(TP=0, FP=0, TN=0, FN=0, unknown=0, PC=0, PQ=0, num_real_duplicates=
     assert TP + FP + TN + FN == num_products * (num_products-1) / 2 
     num_all_comparison = num_products * (num_products-1) / 2 
 
-    precision = TP / (TP + FP)
-    recall = TP / (TP + FN)
+    # no predicted (or no real) duplicates gives a precision (recall) of 0 instead of a division by zero
+    precision = TP / (TP + FP) if TP + FP else 0
+    recall = TP / (TP + FN) if TP + FN else 0
 
     if TP == 0:
         F1 = 0
@@ -77,6 +120,6 @@ def evaluate(TP=0, FP=0, TN=0, FN=0, unknown=0, PC=0, PQ=0, num_real_duplicates=
     return {'precision': precision, 'recall': recall, 'F1': F1, 
             'PQ': PQ, 'PC': PC, 'F1*': F1_star, 
             'num_comparisons': num_comparisons,
-            'proportion_comparisons': num_comparisons/num_all_comparison}
+            'proportion_comparisons': num_comparisons/num_all_comparison if num_all_comparison else 0}
 
 
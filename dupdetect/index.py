@@ -0,0 +1,214 @@
+# Incremental LSH index of products
+#
+# Products are signed with stable token hashes (see minhashing.token_hash), so the signature of a product does not depend
+# on the rest of the catalog. Every product is hashed to its LSH buckets (the band keys of lsh.band_keys, as in detect)
+# and model ID buckets (see lsh.model_buckets). Adding, removing and querying a product only touches its own buckets,
+# and only the pairs of the queried product are classified, with the same outcome as compare.is_duplicate.
+import json
+
+import numpy as np
+
+from preprocessing import get_words
+from minhashing import best_bands, token_hash, sign_rows
+from lsh import band_keys, model_buckets
+from similarity import jaccard
+from detect import flat_product
+
+
+class LSHIndex:
+    """
+    Index of products by their LSH and model ID buckets, supporting incremental updates.
+    Products are identified by a key (a string or an integer, the insertion number by default).
+    Candidates sharing a model ID bucket are classified with threshold 0.0 without brand check and the other
+    candidates with compare_similarity, as in detect with the same token_seed.
+    """
+    def __init__(self, compare_similarity=0.999, lsh_similarity=0.999, num_const=105, num_mult=11, R=2*3*5*7*11*13*17+19, scheme='minhash', token_seed=0):
+        self.params = {'compare_similarity': compare_similarity, 'lsh_similarity': lsh_similarity, 'num_const': num_const,
+                       'num_mult': num_mult, 'R': R, 'scheme': scheme, 'token_seed': token_seed}
+        (self.r, self.b, self.threshold) = best_bands(lsh_similarity, num_const*num_mult)
+        self.entries = {}  # key -> {'product': product, 'slot': row in signatures, 'brand': brand, 'words': compared words, 'buckets': buckets}
+        self.buckets = {}  # bucket -> keys of the products in the bucket
+        self.next_key = 0
+        # The signatures of the indexed products as rows, such that the signatures of candidates are gathered at once
+        self.signatures = np.empty((0, num_const*num_mult), dtype=np.uint32)
+        self.free_slots = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def sign(self, products):
+        """
+        Compute the signatures of a batch of products at once, one column per product.
+        """
+        word_lists = [sorted(get_words(product)) for product in products]
+        indptr = np.cumsum([0] + [len(words) for words in word_lists])
+        rows = np.array(token_hash([word for words in word_lists for word in words], self.params['R'], self.params['token_seed']), dtype=np.int64)
+        return sign_rows(indptr, rows, self.params['num_const'], self.params['num_mult'], self.params['R'], self.params['scheme'])
+
+    def band_keys(self, signatures):
+        """
+        The LSH band keys of a batch of signatures (one column per product) at once, see lsh.band_keys.
+        """
+        return band_keys(signatures, r=self.r, b=self.b)
+
+    def entry(self, product, signature=None, lsh_keys=None):
+        """
+        Preprocess and sign a product (unless its signature is given) and determine its buckets, from its band keys
+        lsh_keys if given (a column of band_keys, which is best computed for a whole batch).
+        Model ID buckets are model ID strings and LSH buckets are (band, band key) tuples.
+        """
+        if signature is None:
+            signature = self.sign([product])[:, 0]
+        if lsh_keys is None:
+            lsh_keys = self.band_keys(signature[:, None])[:, 0]
+        buckets = set(model_buckets(get_words(product)))
+        buckets.update(enumerate(lsh_keys.tolist()))
+        flat = flat_product(product)
+        return {'product': product, 'signature': signature, 'brand': flat['brand'].lower() if 'brand' in flat else None,
+                'words': get_words(flat), 'buckets': buckets}
+
+    def add(self, product, key=None, signature=None, lsh_keys=None):
+        """
+        Add a product to the index under key (by default the next insertion number) and return the key.
+        An existing product with the same key is replaced. signature and lsh_keys are those of entry.
+        """
+        if key is None:
+            while self.next_key in self.entries:
+                self.next_key += 1
+            key = self.next_key
+        if key in self.entries:
+            self.remove(key)
+        entry = self.entry(product, signature, lsh_keys)
+        entry['slot'] = self.store(entry.pop('signature'))
+        self.entries[key] = entry
+        for bucket in entry['buckets']:
+            if bucket in self.buckets:
+                self.buckets[bucket].append(key)
+            else:
+                self.buckets[bucket] = [key]
+        return key
+
+    def remove(self, key):
+        """
+        Remove the product with the given key from the index.
+        """
+        entry = self.entries.pop(key)
+        self.free_slots.append(entry['slot'])
+        for bucket in entry['buckets']:
+            keys = self.buckets[bucket]
+            keys.remove(key)
+            if not keys:
+                del self.buckets[bucket]
+
+    def store(self, signature):
+        """
+        Store a signature in a free row of the signature matrix, which grows by doubling. Returns the row.
+        """
+        if not self.free_slots:
+            num_slots = len(self.signatures)
+            signatures = np.empty((max(16, 2 * num_slots), len(signature)), dtype=signature.dtype)
+            signatures[:num_slots] = self.signatures
+            self.signatures = signatures
+            self.free_slots = list(range(len(signatures) - 1, num_slots - 1, -1))
+        slot = self.free_slots.pop()
+        self.signatures[slot] = signature
+        return slot
+
+    def signature(self, key):
+        return self.signatures[self.entries[key]['slot']]
+
+    def candidates(self, product):
+        """
+        Obtain the keys of the model ID candidates and of the other (LSH) candidates of a product or the key of an indexed product.
+        """
+        return self.bucket_candidates(*self.lookup(product))
+
+    def bucket_candidates(self, entry, own_key=None):
+        mid_candidates, lsh_candidates = set(), set()
+        for bucket in entry['buckets']:
+            (mid_candidates if isinstance(bucket, str) else lsh_candidates).update(self.buckets.get(bucket, ()))
+        mid_candidates.discard(own_key)
+        return mid_candidates, lsh_candidates - mid_candidates - {own_key}
+
+    def query(self, product):
+        """
+        Obtain the keys of the indexed products classified as duplicate of a product or of the indexed product with the given key.
+        Only the candidates of the product are classified.
+        """
+        return [key for key, similarity in self.matches(*self.lookup(product))]
+
+    def matches(self, entry, own_key=None):
+        """
+        Classify the candidates of an entry (see entry). Returns (key, similarity) for every indexed product classified
+        as duplicate, where the similarity is the measure that decided: the signature agreement or the Jaccard similarity.
+        """
+        mid_candidates, lsh_candidates = self.bucket_candidates(entry, own_key)
+        duplicates = []
+        for keys, threshold, check_brand in [(list(lsh_candidates), self.params['compare_similarity'], True), (list(mid_candidates), 0.0, False)]:
+            if not keys:
+                continue
+            others = [self.entries[key] for key in keys]
+            agreement = (self.signatures[[other['slot'] for other in others]] == entry['signature']).mean(axis=1)
+            for key, other, agree in zip(keys, others, agreement.tolist()):
+                # The checks of is_duplicate in the same order
+                if check_brand and entry['brand'] is not None and other['brand'] is not None and entry['brand'] != other['brand']:
+                    continue
+                if agree >= threshold:
+                    duplicates.append((key, agree))
+                elif (similarity := jaccard(entry['words'], other['words'])) > threshold:
+                    duplicates.append((key, similarity))
+        return duplicates
+
+    def extend(self, products, keys=None, batch_size=4096):
+        """
+        Add many products (under the given keys), signing them and computing their band keys in batches of batch_size.
+        Returns the keys.
+        """
+        products = list(products)
+        keys = list(keys) if keys is not None else [None] * len(products)
+        added = []
+        for start in range(0, len(products), batch_size):
+            batch = products[start:start+batch_size]
+            signatures = self.sign(batch)
+            lsh_keys = self.band_keys(signatures)
+            added += [self.add(product, key, signatures[:, k], lsh_keys[:, k]) for k, (product, key) in enumerate(zip(batch, keys[start:start+batch_size]))]
+        return added
+
+    def lookup(self, product):
+        """
+        The entry of a product, or of the indexed product with the given key, and the key (None if it is not indexed).
+        """
+        if isinstance(product, dict):
+            return self.entry(product), None
+        return {**self.entries[product], 'signature': self.signature(product)}, product
+
+    def save(self, file):
+        """
+        Save the index to file (a .npz file), the signatures as array and the parameters, keys and products as JSON.
+        """
+        keys = list(self.entries)
+        n = self.params['num_const'] * self.params['num_mult']
+        signatures = self.signatures[[self.entries[key]['slot'] for key in keys]].T if keys else np.empty((n, 0), dtype=np.uint32)
+        meta = {'params': self.params, 'keys': keys, 'products': [self.entries[key]['product'] for key in keys], 'next_key': self.next_key}
+        with open(file, 'wb') as fp:
+            np.savez(fp, signatures=signatures, meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, file, batch_size=4096):
+        """
+        Load an index saved with save. The buckets are recomputed from the stored products and signatures, with the band
+        keys computed in batches of batch_size.
+        """
+        with np.load(file) as stored:
+            signatures = stored['signatures']
+            meta = json.loads(str(stored['meta']))
+        index = cls(**meta['params'])
+        for start in range(0, len(meta['keys']), batch_size):
+            lsh_keys = index.band_keys(signatures[:, start:start+batch_size])
+            for k in range(start, min(start + batch_size, len(meta['keys']))):
+                index.add(meta['products'][k], meta['keys'][k], signatures[:, k], lsh_keys[:, k - start])
+        index.next_key = meta['next_key']
+        return index
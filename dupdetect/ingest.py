@@ -0,0 +1,204 @@
+# Streaming ingestion of product files
+#
+# Products are read one at a time from either the modelID-keyed JSON format ({"modelID": [product, ...], ...}) or
+# a JSON Lines file with one product per line. Every product is preprocessed and signed as it arrives (in batches),
+# after which only compact per-product state is kept in a Catalog.
+import json
+from array import array
+
+import numpy as np
+
+from preprocessing import clean, clean_line, get_words
+from model_ids import extract_model_ids
+from minhashing import token_hash, sign_rows
+from tokens import Codes, TokenSets
+
+
+def iter_keyed_products(fp, chunk_size=2**20):
+    """
+    Incrementally parse a file in the modelID-keyed format, yielding (key, product) for every product.
+    Only a single product is decoded at a time and the buffer only holds the part of the file that is not yet parsed.
+    """
+    decoder = json.JSONDecoder()
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def read():
+        if state['eof']:
+            return False
+        chunk = fp.read(chunk_size)
+        state['buf'] = state['buf'][state['pos']:] + chunk
+        state['pos'] = 0
+        state['eof'] = chunk == ''
+        return not state['eof']
+
+    def peek():
+        # Next non-whitespace character, '' at the end of the file
+        while True:
+            buf, pos = state['buf'], state['pos']
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf) or not read():
+                return buf[pos] if pos < len(buf) else ''
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError('Expected {!r} at offset {} of the unparsed input'.format(char, state['pos']))
+        state['pos'] += 1
+
+    def value():
+        peek()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(state['buf'], state['pos'])
+                state['pos'] = end
+                return obj
+            except json.JSONDecodeError:
+                if not read():
+                    raise
+
+    def items(close, item):
+        # Items separated by exactly one ',' until close, without a leading or trailing ','
+        if peek() == close:
+            state['pos'] += 1
+            return
+        while True:
+            yield from item()
+            if peek() == close:
+                state['pos'] += 1
+                return
+            expect(',')
+
+    def products(key):
+        product = value()
+        if not isinstance(product, dict):
+            raise ValueError('Expected a product object under key {!r}, got {!r}'.format(key, product))
+        yield key, product
+
+    def group():
+        key = value()
+        if not isinstance(key, str):
+            raise ValueError('Expected a string key, got {!r}'.format(key))
+        expect(':')
+        expect('[')
+        yield from items(']', lambda: products(key))
+
+    expect('{')
+    yield from items('}', group)
+    if peek() != '':
+        raise ValueError('Unexpected data after the catalog at offset {} of the unparsed input'.format(state['pos']))
+
+def iter_products(file):
+    """
+    Yield all products in file. Files ending in .jsonl are read as JSON Lines, other files in the modelID-keyed format.
+    """
+    with open(file, 'r') as fp:
+        if file.endswith('.jsonl'):
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for key, product in iter_keyed_products(fp):
+                yield product
+
+
+class Catalog:
+    """
+    Compact per-product state of a product stream: the token ids of the product words and of the words used for
+    comparison, the candidate model IDs, the signature column and integer codes for brand, shop and modelID (-1 if absent).
+    Signatures use stable token hashes (see minhashing.token_hash) such that products can be signed per batch.
+    """
+    def __init__(self, num_const=105, num_mult=11, R=2*3*5*7*11*13*17+19, scheme='minhash', token_seed=0, batch_size=4096):
+        self.params = {'num_const': num_const, 'num_mult': num_mult, 'R': R, 'scheme': scheme}
+        self.token_seed = token_seed
+        self.batch_size = batch_size
+
+        self.tokens = Codes()
+        self.token_rows = array('q')  # Stable hash of every token id
+        self.brands, self.shops, self.model_ids, self.mid_codes = Codes(), Codes(), Codes(), Codes()
+
+        # CSR structures, the offsets of product p are [indptr[p], indptr[p+1])
+        self.word_indptr, self.word_ids = array('q', [0]), array('i')
+        self.compare_indptr, self.compare_ids = array('q', [0]), array('i')
+        self.mid_indptr, self.mid_ids = array('q', [0]), array('i')
+        self.brand, self.shop, self.model_id = array('i'), array('i'), array('i')
+
+        self.num_products = 0
+        self.num_signed = 0
+        self.M = np.empty((num_const*num_mult, 0), dtype=np.uint32)
+
+    def intern(self, words):
+        ids = sorted(self.tokens(w) for w in words)
+        new_words = self.tokens.names[len(self.token_rows):]
+        self.token_rows.extend(token_hash(new_words, self.params['R'], self.token_seed))
+        return ids
+
+    def add(self, product):
+        """
+        Preprocess a product and store its compact state. Signs the pending products once a batch is full.
+        """
+        features = {clean(k).replace('brand name', 'brand'): clean_line(v) for k, v in product['featuresMap'].items()}
+        words = get_words(product)
+
+        self.word_ids.extend(self.intern(words))
+        self.word_indptr.append(len(self.word_ids))
+        self.compare_ids.extend(self.intern(get_words({'title': clean_line(product['title'])})))
+        self.compare_indptr.append(len(self.compare_ids))
+        self.mid_ids.extend(self.mid_codes(mid) for mid in extract_model_ids(words))
+        self.mid_indptr.append(len(self.mid_ids))
+
+        self.brand.append(self.brands(features['brand'].lower()) if 'brand' in features else -1)
+        self.shop.append(self.shops(product['shop'].lower()))
+        self.model_id.append(self.model_ids(product['modelID']) if 'modelID' in product else -1)
+
+        self.num_products += 1
+        if self.num_products - self.num_signed >= self.batch_size:
+            self.sign()
+
+    def sign(self):
+        """
+        Compute the signatures of the products that are not signed yet.
+        """
+        if self.num_signed == self.num_products:
+            return
+        indptr = np.frombuffer(self.word_indptr, dtype=np.int64)[self.num_signed:self.num_products+1]
+        rows = np.frombuffer(self.token_rows, dtype=np.int64)[np.frombuffer(self.word_ids, dtype=np.int32)[indptr[0]:indptr[-1]]]
+        signatures = sign_rows(indptr - indptr[0], rows, **self.params)
+
+        # Grow the signature matrix by doubling
+        if self.M.shape[1] < self.num_products:
+            M = np.empty((self.M.shape[0], max(self.num_products, 2 * self.M.shape[1])), dtype=signatures.dtype)
+            M[:, :self.num_signed] = self.M[:, :self.num_signed]
+            self.M = M
+        self.M[:, self.num_signed:self.num_products] = signatures
+        self.num_signed = self.num_products
+
+    @property
+    def signatures(self):
+        self.sign()
+        return self.M[:, :self.num_products]
+
+    def token_sets(self, compare=False):
+        """
+        The token ids of every product as tokens.TokenSets, of the words used in comparison if compare is True.
+        """
+        indptr, ids = (self.compare_indptr, self.compare_ids) if compare else (self.word_indptr, self.word_ids)
+        return TokenSets(np.array(indptr, dtype=np.int64), np.array(ids, dtype=np.int32), self.tokens)
+
+    def arrays(self, name):
+        """
+        A copy of one of the compact per-product arrays ('brand', 'shop', 'model_id') or CSR arrays ('mid_indptr', 'mid_ids') as numpy array.
+        """
+        values = getattr(self, name)
+        return np.array(values, dtype=np.int64 if values.typecode == 'q' else np.int32)
+
+
+def read_catalog(file, **kwargs):
+    """
+    Stream all products in file into a Catalog. Keyword arguments are passed to Catalog.
+    """
+    catalog = Catalog(**kwargs)
+    for product in iter_products(file):
+        catalog.add(product)
+    catalog.sign()
+    return catalog
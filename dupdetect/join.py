@@ -0,0 +1,90 @@
+# Exact similarity join of word sets (as tokens.TokenSets)
+#
+# An alternative to the LSH candidates: all pairs of sets with a Jaccard similarity of at least a threshold are found
+# exactly, with the length, prefix and positional filters of PPJoin (Xiao et al., Efficient similarity joins for near
+# duplicate detection). The tokens of every set are ordered by increasing frequency, such that the prefixes consist of rare
+# tokens, and the sets are processed by increasing size. A set is only compared to the sets sharing a token of its prefix,
+# and only the pairs that survive the filters are verified, all at once.
+import math
+
+import numpy as np
+
+from tokens import intersection_sizes
+
+EPSILON = 1e-9  # Margin on the filter bounds against rounding errors, which can only admit more pairs
+
+
+def token_ranks(token_sets):
+    """
+    Replace the token ids of every set by their rank in the global order of increasing frequency (ties by id).
+    Returns a sorted list of ranks per set, such that the prefix of a set holds its rarest tokens.
+    """
+    counts = np.bincount(token_sets.ids)
+    ranks = np.empty(len(counts), dtype=np.int64)
+    ranks[np.argsort(counts, kind='stable')] = np.arange(len(counts))
+    products = token_sets.products()
+    ranks = ranks[token_sets.ids]
+    ranks = ranks[np.lexsort((ranks, products))].tolist()
+    indptr = token_sets.indptr.tolist()
+    return [ranks[indptr[k]:indptr[k+1]] for k in range(len(token_sets))]
+
+
+def similarity_join(token_sets, threshold):
+    """
+    Find all pairs of the sets of token_sets (a tokens.TokenSets) with Jaccard similarity (as similarity.jaccard) of at least
+    threshold, with threshold <= 1. Empty sets are not paired; with threshold <= 0 all other sets are.
+    Returns sorted int64 pair keys i * len(token_sets) + j with i < j, as lsh.bucket_pairs.
+    """
+    assert threshold <= 1
+    num_sets = len(token_sets)
+    if threshold <= 0:
+        # Every pair qualifies, also those without a shared token, which the prefixes cannot find
+        nonempty = np.flatnonzero(token_sets.sizes() > 0)
+        i, j = np.triu_indices(len(nonempty), 1)
+        return nonempty[i] * num_sets + nonempty[j]
+    records = token_ranks(token_sets)
+    coefficient = threshold / (1 + threshold)
+    index = {}  # token -> [(set, position of the token in the set)] of the indexed prefixes, by increasing set size
+    starts = {}  # token -> first entry of index[token] that is not too short for the current set (the length filter)
+    firsts, seconds = [], []  # The candidate pairs, each found once (when its larger set is processed)
+    for x in sorted((k for k in range(num_sets) if records[k]), key=lambda k: len(records[k])):
+        rx = records[x]
+        lx = len(rx)
+        min_length = threshold * lx - EPSILON
+        # Sets with at least the required overlap share a token of their probing prefixes
+        probe_length = min(lx, lx - math.ceil(threshold * lx - EPSILON) + 1)
+        overlaps = {}
+        for i in range(probe_length):
+            entries = index.get(rx[i])
+            if entries is None:
+                continue
+            start = starts[rx[i]]
+            while start < len(entries) and len(records[entries[start][0]]) < min_length:
+                start += 1
+            starts[rx[i]] = start
+            for y, j in entries[start:]:
+                ly = len(records[y])
+                # Positional filter: the overlap so far plus the overlap still possible must reach the required overlap
+                required = math.ceil(coefficient * (lx + ly) - EPSILON)
+                overlap = overlaps.get(y, 0)
+                overlaps[y] = overlap + 1 if overlap + 1 + min(lx - i - 1, ly - j - 1) >= required else -math.inf
+
+        found = [y for y, overlap in overlaps.items() if overlap > 0]
+        firsts += [x] * len(found)
+        seconds += found
+
+        # Index the prefix that a later (larger) set needs to share with x
+        for i in range(lx - math.ceil(2 * coefficient * lx - EPSILON) + 1):
+            if rx[i] in index:
+                index[rx[i]].append((x, i))
+            else:
+                index[rx[i]] = [(x, i)]
+                starts[rx[i]] = 0
+
+    # Verify the candidates on their complete sets
+    firsts, seconds = np.array(firsts, dtype=np.int64), np.array(seconds, dtype=np.int64)
+    candidates = np.sort(np.minimum(firsts, seconds) * num_sets + np.maximum(firsts, seconds))
+    i1, i2 = np.divmod(candidates, num_sets)
+    overlap = intersection_sizes(token_sets, i1, i2)
+    sizes = token_sets.sizes()
+    return candidates[overlap / (sizes[i1] + sizes[i2] - overlap) >= threshold]
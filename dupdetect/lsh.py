@@ -1,20 +1,8 @@
-from model_ids import extract_model_ids
+import numpy as np
 
-def lsh(signature, r=5, b=20):
-    """
-    Maps a signature to b different 'buckets' using Locality Sensitive Hashing.
-    :param signature: A signature, list of length n with integers (obtained from minhashing, where n is the number of permutations used for minhashing)
-    :param b: Number of bands, this is the different number of buckets a signature is hashed to
-    :param r: The size of a band, this is implied by N/b. 
-    The hashing to a bucket is done via a dict object. The integers are concatenated as strings to form the hash string. They are prefixed with the band number and a hyphen
-    to prevent other bands with the same sequence of minhash values to map to the same bucket. This means that every band maps to its own set of buckets, such that bands
-    at different positions in the signature for two signatures do not hash to the same bucket. 
-    The hash string is the identifier of the bucket the signature is hashed to. 
-    """
-    assert r*b == len(signature)
-    bands = [signature[i*r:(i+1)*r] for i in range(b)]  # Split into bands
-    buckets = {str(b)+ '-' + ''.join([str(int(s)) for s in band]) for b, band in enumerate(bands)}
-    return buckets
+from model_ids import extract_model_ids
+from minhashing import PackedSignatures
+from tokens import Codes
 
 
 def model_buckets(product_set):
@@ -24,18 +12,190 @@ def model_buckets(product_set):
     return extract_model_ids(product_set)
 
     
-def add_to_buckets(buckets, signature, product_index, bs):
+def band_keys(signatures, r=5, b=20, chunk_size=2**22):
+    """
+    Hashes every band of every signature to an integer key at once.
+    :param signatures: The n x p signature matrix, with a signature in every column, or its minhashing.PackedSignatures
+    The values are reinterpreted as unsigned integers of the same size (the bytes of the signature array) and combined per band
+    with a multiply-add followed by a final mix. Returns a b x p array of uint64 keys, which are compared per band only.
+    Two different bands only share a key through a 64-bit hash collision, which only adds a candidate.
+    Packed values are hashed as bytes: with 8 bits these are the packed bytes, otherwise the values are unpacked for
+    chunks of about chunk_size values at a time.
     """
-    Hash to buckets
-    r and b are determined in the previous cell
-    r = Number of signature rows per band
-    b = Number of bands
-    ! b times r must be equal to n
+    n, p = signatures.shape
+    assert r*b == n
+    if isinstance(signatures, PackedSignatures):
+        if signatures.bits == 8:
+            return band_keys(signatures.packed, r, b)
+        step = max(1, chunk_size // n)
+        return np.concatenate([band_keys(signatures.values(slice(start, start + step)), r, b) for start in range(0, p, step)], axis=1)
+    values = np.ascontiguousarray(signatures).view('u{}'.format(signatures.dtype.itemsize)).reshape(b, r, p)
+    keys = np.full((b, p), 0xcbf29ce484222325, dtype=np.uint64)
+    for row in range(r):
+        keys = keys * np.uint64(0x100000001b3) + values[:, row, :].astype(np.uint64)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xff51afd7ed558ccd)
+    keys ^= keys >> np.uint64(33)
+    return keys
+
+
+def group(products, *keys):
+    """
+    Groups the product indices by their (combination of) keys, using a sort instead of a dict of lists.
+    Returns (products, starts) where bucket k holds products[starts[k]:starts[k+1]], in ascending order.
+    """
+    order = np.lexsort((products, *keys[::-1]))
+    products = products[order]
+    new_bucket = np.zeros(len(products), dtype=bool)
+    new_bucket[:1] = True
+    for key in keys:
+        key = key[order]
+        new_bucket[1:] |= key[1:] != key[:-1]
+    return products, np.flatnonzero(new_bucket)
+
+
+def band_buckets(signatures, r=5, b=20):
+    """
+    Maps all signatures to their b buckets at once, one bucket per band and band key (see band_keys).
+    Buckets only store product indices. Returns (products, starts) as in group.
+    """
+    keys = band_keys(signatures, r=r, b=b)
+    bands = np.repeat(np.arange(b), keys.shape[1])
+    products = np.tile(np.arange(keys.shape[1]), b)
+    return group(products, bands, keys.ravel())
+
+
+class LSHForest:
+    """
+    Prefix trees over signature bands (Bawa et al., LSH Forest): tree t covers the rows t * depth to (t+1) * depth - 1
+    of the signatures, and the products that share the first k of these rows are the leaves below one node at depth k.
+    Every tree is stored as the products in lexicographic order of the bytes of their rows (ties by product) together with
+    the length of the longest common prefix (lcp) of every product with the next one, so the products below a node form a run.
+    Sorting the rows of a product as one byte string takes a single sort per tree instead of one per row.
+    The buckets of any prefix length k <= depth and any number of trees l <= num_trees are read from the same forest,
+    which trades recall against the number of candidates without recomputing signatures or bands.
+    """
+    def __init__(self, signatures, depth, num_trees=None):
+        """
+        Build num_trees (default n // depth) trees over the n x p signatures, or their minhashing.PackedSignatures.
+        """
+        n, p = signatures.shape
+        num_trees = n // depth if num_trees is None else num_trees
+        assert 0 < depth * num_trees <= n
+        if isinstance(signatures, PackedSignatures):
+            signatures = signatures.values()
+        self.depth = depth
+        self.orders = np.empty((num_trees, p), dtype=np.int64)
+        self.lcp = np.empty((num_trees, max(p-1, 0)), dtype=np.int32)
+        for t in range(num_trees):
+            rows = signatures[t*depth:(t+1)*depth]
+            order = np.argsort(np.ascontiguousarray(rows.T).view('V{}'.format(rows.itemsize * depth)).ravel(), kind='stable')
+            rows = rows[:, order]
+            differs = rows[:, 1:] != rows[:, :-1]
+            self.orders[t] = order
+            self.lcp[t] = np.where(differs.any(axis=0), differs.argmax(axis=0), depth)
+
+    @property
+    def num_trees(self):
+        return len(self.orders)
+
+    def buckets(self, k=None, l=None):
+        """
+        The buckets of the products sharing the first k rows (default depth) of one of the first l trees (default all),
+        as banding with r = k and b = l does. Returns (products, starts) as in group.
+        """
+        k = self.depth if k is None else k
+        l = self.num_trees if l is None else l
+        assert 0 < k <= self.depth and 0 < l <= self.num_trees
+        p = self.orders.shape[1]
+        new_bucket = np.ones((l, p), dtype=bool)
+        new_bucket[:, 1:] = self.lcp[:l] < k
+        products, new_bucket = self.orders[:l].ravel(), new_bucket.ravel()
+        if k < self.depth:
+            # The products of a shorter prefix are ordered by their remaining rows, instead of ascending as in group
+            products = products[np.lexsort((products, np.cumsum(new_bucket)))]
+        return products, np.flatnonzero(new_bucket)
+
+
+def model_id_buckets(token_sets):
     """
+    Maps all products to the buckets of their model IDs (see model_buckets), given their word sets as tokens.TokenSets.
+    The model ID of every distinct token is extracted only once. Returns (products, starts) as in group.
+    """
+    used, inverse = np.unique(token_sets.ids, return_inverse=True)
+    mid_codes = Codes()
+    code_of = np.full(len(used), -1, dtype=np.int64)
+    for k, i in enumerate(used.tolist()):
+        for mid in model_buckets({token_sets.tokens.names[i]}):
+            code_of[k] = mid_codes(mid)
+    codes = code_of[inverse.ravel()]
+    has_mid = codes >= 0
+    # Tokens that only differ by hyphens give the same model ID, which is a single bucket entry
+    entries = np.unique(token_sets.products()[has_mid] * max(len(mid_codes), 1) + codes[has_mid])
+    products, keys = np.divmod(entries, max(len(mid_codes), 1))
+    return group(products, keys)
+
+
+def bucket_sizes(products, starts):
+    return np.diff(np.append(starts, len(products)))
+
+
+def unique_runs(keys):
+    """
+    np.unique of keys made of long sorted runs, such as the pair keys of the buckets. The stable sort (timsort for
+    integers) merges the runs instead of sorting all keys again.
+    """
+    keys = np.sort(keys, kind='stable')
+    keep = np.ones(len(keys), dtype=bool)
+    keep[1:] = keys[1:] != keys[:-1]
+    return keys[keep]
+
+
+def union_runs(runs, chunk_size=2**22):
+    """
+    The sorted unique keys of all arrays of sorted unique keys in runs (an iterable, such as a generator), merged as they
+    come instead of all at once: the merged keys are only merged again with the pending runs once these hold at least
+    chunk_size keys and as many keys as the merged ones, so memory stays bounded by about three times the unique keys
+    (and chunk_size), while every key is merged a logarithmic number of times at most.
+    """
+    merged, pending, num_pending = np.empty(0, dtype=np.int64), [], 0
+    for keys in runs:
+        pending.append(keys)
+        num_pending += len(keys)
+        if num_pending >= max(chunk_size, len(merged)):
+            merged, pending, num_pending = unique_runs(np.concatenate([merged] + pending)), [], 0
+    return unique_runs(np.concatenate([merged] + pending)) if pending else merged
+
+
+def bucket_chunks(sizes, chunk_size=2**22):
+    """
+    Split the buckets of the given sizes into ranges [start, stop) of consecutive buckets with at most chunk_size pairs
+    in total, or a single bucket with more pairs. Yields the ranges.
+    """
+    total = np.cumsum(sizes * (sizes - 1) // 2)
+    start = 0
+    while start < len(sizes):
+        done = total[start - 1] if start else 0
+        stop = max(int(np.searchsorted(total, done + chunk_size, side='right')), start + 1)
+        yield start, stop
+        start = stop
+
+
+def bucket_pairs(products, starts, num_products, chunk_size=2**22):
+    """
+    Generate all pairs of products that share a bucket, as sorted unique int64 pair keys i * num_products + j with i < j.
+    Buckets of the same size are expanded together; the pairs of a bucket are already sorted, as its products are.
+    The buckets are expanded in chunks of about chunk_size pairs whose unique pairs are merged as they come (see
+    union_runs), so the pairs repeated across buckets and bands are never all in memory at once.
+    """
+    sizes = bucket_sizes(products, starts)
+
+    def chunk_pairs(start, stop):
+        pair_keys = [np.empty(0, dtype=np.int64)]
+        for size in np.unique(sizes[start:stop][sizes[start:stop] >= 2]):
+            first = starts[start:stop][sizes[start:stop] == size][:, None]
+            i, j = np.triu_indices(size, 1)
+            pair_keys.append((products[first + i] * num_products + products[first + j]).ravel())
+        return unique_runs(np.concatenate(pair_keys))
 
-    new_element = (''.join([str(int(s)) for s in signature]), product_index)
-    for bucket in bs:
-        if bucket in buckets:
-            buckets[bucket].append(new_element)
-        else:
-            buckets[bucket] = [new_element]
\ No newline at end of file
+    return union_runs((chunk_pairs(start, stop) for start, stop in bucket_chunks(sizes, chunk_size)), chunk_size)
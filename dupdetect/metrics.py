@@ -0,0 +1,77 @@
+# Instrumentation of the detection stages
+#
+# A Metrics object is passed through detect and its stages. It records the wall time, CPU time and (optionally) the
+# peak allocation of every stage, counts such as the number of candidates and histograms of the bucket sizes,
+# and prints the progress messages unless it is quiet.
+import contextlib
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class Metrics:
+    """
+    Measurements of a detection run. Stages that run more than once (such as the candidate generation of a sweep)
+    accumulate their times, keep the largest peak allocation and count their calls.
+    :param quiet: Suppress the progress messages of log
+    :param memory: Measure the peak allocation of every stage with tracemalloc, which slows the stages down
+    """
+    def __init__(self, quiet=False, memory=False):
+        self.quiet = quiet
+        self.memory = memory
+        self.stages = {}
+        self.counts = {}
+        self.histograms = {}
+
+    def log(self, *args):
+        """
+        Print a progress message, unless quiet.
+        """
+        if not self.quiet:
+            print(*args)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure the code in the with block as stage name.
+        """
+        started = self.memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        if self.memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stage['wall'] += time.perf_counter() - start_wall
+            stage['cpu'] += time.process_time() - start_cpu
+            stage['calls'] += 1
+            if self.memory:
+                stage['peak_memory'] = max(stage.get('peak_memory', 0), tracemalloc.get_traced_memory()[1] - start_memory)
+            if started:
+                tracemalloc.stop()
+
+    def count(self, name, value):
+        self.counts[name] = int(value)
+
+    def histogram(self, name, values):
+        """
+        Record the histogram of the non-negative integers values (such as bucket sizes) as lists of the occurring values and their frequencies.
+        """
+        frequencies = np.bincount(values)
+        occurring = np.flatnonzero(frequencies)
+        self.histograms[name] = {'values': occurring.tolist(), 'frequencies': frequencies[occurring].tolist()}
+
+    def to_dict(self):
+        return {'stages': self.stages, 'counts': self.counts, 'histograms': self.histograms}
+
+    def dump(self, file, **extra):
+        """
+        Write the measurements (and the extra entries, such as the performance) to file as JSON.
+        """
+        json.dump({**self.to_dict(), **extra}, open(file, 'w'), indent=1)
@@ -1,7 +1,22 @@
+from hashlib import blake2b
+from functools import lru_cache
 from itertools import product
 import numpy as np
 
 from preprocessing import get_words
+from cache import cached_signatures
+from tokens import intern_sets
+
+
+EMPTY = np.iinfo(np.uint32).max  # Signature value of the products without words
+
+
+def signature_dtype(bound):
+    """
+    The dtype of signature values below bound: uint32, which leaves EMPTY for the products without words.
+    """
+    assert bound <= EMPTY
+    return np.uint32
 
 
 # Find the optimal value for r and b given the desired similarity
@@ -54,6 +69,19 @@ def best_bands(desired_sim, n):
     best = min(opt_s, key=lambda option: abs(option[2] - desired_sim)) # Find pair with threshold closest to desired similarity.
     return best
 
+def forest_bands(desired_sim, n):
+    """
+    Find the prefix length k and number of trees l of an LSH forest (see lsh.LSHForest) with the threshold closest to desired_sim,
+    like best_bands. Every k up to n is considered, with as many trees as fit in n rows (l = n // k), so the thresholds
+    are much closer together than those of the divisors of n. The threshold (where a(s, k, l) = 0.5) is (1 - 0.5^(1/l))^(1/k).
+    Returns (k, l, threshold).
+    """
+    k = np.arange(1, n+1)
+    l = n // k
+    thresholds = (1 - 0.5**(1/l))**(1/k)
+    best = int(np.argmin(np.abs(thresholds - desired_sim)))
+    return int(k[best]), int(l[best]), float(thresholds[best])
+
 def isprime(number):
     for i in range(2, int(number**0.5)+1):
         if number % i == 0:
@@ -69,27 +97,260 @@ def generate_minhash_funcs(num_const, num_mult, R):
     return hash_funcs
 
 
-def make_signatures(word_set, product_sets, hash_funcs, n, R):
-    M = np.ones((n, len(product_sets))) * np.inf  # M is the signature matrix of n x p (n = # hashfunctions, p = number of products)
-    h_i = np.zeros(n)
-    for (row, w) in enumerate(word_set): 
-        for h, (const, mult) in enumerate(hash_funcs): # Obtain the hash function parameters           
-            h_i[h] = (const + mult * (row+1)) % R # Maps the row to the permutation 
-            assert h_i[h] < np.inf
-        for h, perm_row in enumerate(h_i):
-            for index, product_set in enumerate(product_sets):
-                if w in product_set:
-                    M[h, index] = min(M[h,index], perm_row)
+def token_hash(words, R, seed=0):
+    """
+    Hash every word to a stable row in [1, R), independent of the vocabulary the word is part of.
+    The seed is used as blake2b salt, so different seeds give independent rows.
+    """
+    salt = seed.to_bytes(16, 'little')
+    return [int.from_bytes(blake2b(w.encode(), digest_size=8, salt=salt).digest(), 'little') % (R-1) + 1 for w in words]
+
+
+def incidence(word_set, product_sets, R=None, token_seed=None):
+    """
+    Build the sparse product x word incidence structure in CSR form.
+    Returns (indptr, rows) where rows[indptr[p]:indptr[p+1]] are the (1-based) rows in word_set of the words of product p.
+    Words that are not in word_set are ignored.
+    If a token_seed is given, the rows are the stable token hashes of the words instead (see token_hash), so the signature
+    of a product does not depend on the other products in word_set.
+    """
+    if token_seed is None:
+        row_of = {w: row+1 for (row, w) in enumerate(word_set)}
+    else:
+        row_of = dict(zip(word_set, token_hash(word_set, R, token_seed)))
+    product_rows = [[row_of[w] for w in product_set if w in row_of] for product_set in product_sets]
+    indptr = np.zeros(len(product_rows)+1, dtype=np.int64)
+    np.cumsum([len(rows) for rows in product_rows], out=indptr[1:])
+    rows = np.fromiter((row for rows in product_rows for row in rows), dtype=np.int64, count=indptr[-1])
+    return indptr, rows
+
+
+def token_incidence(token_sets, R=None, token_seed=None):
+    """
+    The incidence structure of incidence for the word sets of the products as tokens.TokenSets, without building a set or
+    list per product: the rows are the (1-based) ranks of the words in the sorted vocabulary of the token sets, or their
+    stable token hashes if a token_seed is given.
+    """
+    used, inverse = np.unique(token_sets.ids, return_inverse=True)
+    words = [token_sets.tokens.names[i] for i in used.tolist()]
+    if token_seed is None:
+        row_of = np.empty(len(words), dtype=np.int64)
+        row_of[sorted(range(len(words)), key=words.__getitem__)] = np.arange(1, len(words)+1)
+    else:
+        row_of = np.array(token_hash(words, R, token_seed), dtype=np.int64)
+    return token_sets.indptr, row_of[inverse.ravel()]
+
+
+def make_signatures(word_set, product_sets, hash_funcs, n, R, chunk_size=2**22, token_seed=None):
+    """
+    Compute the signature matrix M of n x p (n = # hashfunctions, p = number of products).
+    All permutations (const + mult * row) % R are evaluated at once for the non-zero (product, word) entries and
+    reduced to the per-product minimum, in chunks of about chunk_size values to bound memory.
+    The values are stored as uint32 (see signature_dtype) and products without any words keep a signature of EMPTY.
+    With a token_seed the rows are stable token hashes, such that the columns of a signature matrix for a whole dataset
+    are the signatures of the products in any subset of it.
+    """
+    indptr, rows = incidence(word_set, product_sets, R, token_seed)
+    return minhash_rows(indptr, rows, hash_funcs, n, R, chunk_size)
+
+def minhash_rows(indptr, rows, hash_funcs, n, R, chunk_size=2**22):
+    """
+    Compute the signature matrix of make_signatures from the incidence structure (indptr, rows) of the products.
+    """
+    funcs = (hash_funcs if isinstance(hash_funcs, np.ndarray) else np.array(list(hash_funcs), dtype=np.int64)).reshape(-1, 2)[:n]
+    const, mult = funcs[:, 0:1], funcs[:, 1:2]
+
+    M = np.full((n, len(indptr)-1), EMPTY, dtype=signature_dtype(R))
+
+    nonempty = np.flatnonzero(np.diff(indptr))
+    ends = indptr[nonempty+1]
+    step = max(1, chunk_size // max(n, 1))  # Number of entries per chunk
+    lo = 0
+    while lo < len(nonempty):
+        start = indptr[nonempty[lo]]
+        hi = max(lo+1, int(np.searchsorted(ends, start + step, side='right')))
+        chunk = nonempty[lo:hi]
+        perm_rows = (const + mult * rows[start:ends[hi-1]]) % R  # Maps the rows to the permutations
+        M[:, chunk] = np.minimum.reduceat(perm_rows, indptr[chunk] - start, axis=1)
+        lo = hi
     return M
 
-def precompute_signatures(data, num_const=105, num_mult=11, R=2*3*5*7*11*13*17+19, *args, **kwargs):
-    products = [product for products in list(data.values()) for product in products]
+def previous_filled(keys, n, num_products):
+    """
+    For the sorted keys (product * n + bin) of the filled bins, find for every (product, bin) position the nearest filled bin
+    at or before it, wrapping around to the last filled bin of the product (minus n). The result is a flat array in product-major order.
+    It is built with a single np.repeat over the runs between filled bins, so the cost does not depend on the number of empty bins.
+    """
+    starts = np.arange(num_products, dtype=np.int64) * n
+    bounds = np.union1d(keys, starts)
+    columns = bounds // n
 
-    all_words = sorted({word for product in products for word in get_words(product)})
-    product_sets = [get_words(product) for product in products]
+    last = np.searchsorted(keys, starts + n) - 1  # Index of the last filled key of each product
+    last_bin = np.where(last >= 0, keys[np.maximum(last, 0)] - starts, 0) - n
 
-    assert isprime(R)
+    prev = np.searchsorted(keys, bounds, side='right') - 1
+    prev_key = keys[np.maximum(prev, 0)]
+    values = np.where((prev >= 0) & (prev_key >= starts[columns]), prev_key - starts[columns], last_bin[columns])
+    return np.repeat(values, np.diff(np.append(bounds, num_products * n)))
+
+
+def make_oph_signatures(word_set, product_sets, n, R, seed=0, token_seed=None):
+    """
+    Compute an n x p signature matrix using one-permutation hashing (OPH) with densification.
+    Every word row is hashed only once with a single permutation (const + mult * row) % R, the hash range is split into n bins
+    and each bin keeps the minimum hash of the words falling into it. Empty bins are densified by borrowing the value
+    of the nearest non-empty bin, to the left or to the right as decided by a fixed random bit per bin, offset by
+    the distance times R such that borrowed values do not collide with real ones ('improved densification').
+    The result has the same shape as make_signatures, so it can be used for lsh and compare in the same way.
+    Products without any words keep a signature of EMPTY. The token_seed works as in make_signatures.
+    """
+    indptr, rows = incidence(word_set, product_sets, R, token_seed)
+    return oph_rows(indptr, rows, n, R, seed)
+
+def oph_rows(indptr, rows, n, R, seed=0):
+    """
+    Compute the signature matrix of make_oph_signatures from the incidence structure (indptr, rows) of the products.
+    """
+    rng = np.random.default_rng(seed)
+    const, mult = int(rng.integers(0, R)), int(rng.integers(1, R))
+    go_right = rng.integers(0, 2, size=n).astype(bool)
+
+    num_products = len(indptr)-1
+
+    # Hash every (product, word) entry once and keep the minimum per bin
+    h = (const + mult * rows) % R
+    keys = np.repeat(np.arange(num_products, dtype=np.int64) * n, np.diff(indptr)) + h * n // R
+    order = np.lexsort((h, keys))
+    keys, first = np.unique(keys[order], return_index=True)
+    filled = np.zeros(num_products * n, dtype=np.int64)
+    filled[keys] = h[order][first]
+
+    # Densify the empty bins (in product-major order, positions are the bins within a product)
+    positions = np.arange(n)
+    left = previous_filled(keys, n, num_products).reshape(num_products, n)
+    mirrored = np.sort(keys - keys % n + (n - 1 - keys % n))
+    right = n - 1 - previous_filled(mirrored, n, num_products).reshape(num_products, n)[:, ::-1]
+
+    distance = np.where(go_right, right - positions, positions - left)
+    source = np.where(go_right, right, left) % n + (np.arange(num_products) * n)[:, None]
+    M = (filled[source] + distance * R).astype(signature_dtype(n * R))
+
+    has_words = np.diff(indptr) > 0
+    M[~has_words] = EMPTY
+    return M.T
+
+def compute_signatures(token_sets, num_const=105, num_mult=11, R=2*3*5*7*11*13*17+19, scheme='minhash', token_seed=None):
+    """
+    Compute the signature matrix of n = num_const * num_mult rows for the given scheme ('minhash' or 'oph') of the
+    word sets of the products as tokens.TokenSets (see token_incidence).
+    """
+    indptr, rows = token_incidence(token_sets, R, token_seed)
+    return sign_rows(indptr, rows, num_const, num_mult, R, scheme)
 
-    hash_funcs = list(generate_minhash_funcs(num_const, num_mult, R))
+def sign_rows(indptr, rows, num_const=105, num_mult=11, R=2*3*5*7*11*13*17+19, scheme='minhash'):
+    """
+    Compute the signature matrix for the given scheme from the incidence structure (indptr, rows) of the products (see incidence).
+    """
+    if scheme == 'oph':
+        assert isprime(R)
+        return oph_rows(indptr, rows, num_const*num_mult, R)
+
+    hash_funcs = minhash_func_array(num_const, num_mult, R)
     
-    return make_signatures(all_words, product_sets, hash_funcs, len(hash_funcs), R)
+    return minhash_rows(indptr, rows, hash_funcs, len(hash_funcs), R)
+
+@lru_cache(maxsize=None)
+def minhash_func_array(num_const, num_mult, R):
+    """
+    The (const, mult) pairs of generate_minhash_funcs as a read-only n x 2 array, computed once per setting
+    such that signing a small batch of products (see index.LSHIndex) does not pay for it every time.
+    """
+    assert isprime(R)
+    funcs = np.array(list(generate_minhash_funcs(num_const, num_mult, R)), dtype=np.int64)
+    funcs.setflags(write=False)
+    return funcs
+
+# b-bit minwise hashing (Li and König, b-Bit minwise hashing): only the lowest bits of every signature value are kept,
+# 8 // bits values per byte. Two values agree by chance with probability about 2^-bits, which the agreement corrects for.
+POPCOUNT = np.array([bin(k).count('1') for k in range(256)], dtype=np.uint8)
+
+
+def pack_signatures(signatures, bits):
+    """
+    Pack the lowest bits (1, 2, 4 or 8) of every value of the n x p signature matrix into a uint8 matrix of
+    ceil(n * bits / 8) x p: value k of a column is stored in byte k // (8 // bits), the first value in the lowest bits.
+    """
+    assert bits in (1, 2, 4, 8)
+    n, p = signatures.shape
+    per_byte = 8 // bits
+    values = np.zeros((-(-n // per_byte) * per_byte, p), dtype=np.uint8)
+    values[:n] = signatures & (2**bits - 1)
+    values = values.reshape(-1, per_byte, p)
+    packed = values[:, 0, :].copy()
+    for k in range(1, per_byte):
+        packed |= values[:, k, :] << k * bits
+    return packed
+
+
+class PackedSignatures:
+    """
+    A signature matrix of num_hashes x p packed by pack_signatures, which takes the place of the full matrix in
+    lsh.band_buckets and compare.signature_agreement. shape is that of the full matrix.
+    """
+    def __init__(self, packed, bits, num_hashes):
+        self.packed = packed
+        self.bits = bits
+        self.num_hashes = num_hashes
+        self.shape = (num_hashes, packed.shape[1])
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def values(self, columns=slice(None)):
+        """
+        The b-bit values of the given columns as a uint8 matrix of num_hashes rows.
+        """
+        packed = self.packed[:, columns]
+        per_byte = 8 // self.bits
+        values = np.empty((packed.shape[0], per_byte, packed.shape[1]), dtype=np.uint8)
+        for k in range(per_byte):
+            values[:, k, :] = (packed >> k * self.bits) & (2**self.bits - 1)
+        return values.reshape(-1, packed.shape[1])[:self.num_hashes]
+
+    def agreement(self, i1, i2):
+        """
+        Estimate the fraction of equal full signature values of every pair (i1, i2) from the fraction P of equal b-bit values,
+        which are compared on the packed bytes: (P - 2^-bits) / (1 - 2^-bits), clipped to [0, 1].
+        """
+        differ = self.packed[:, i1] ^ self.packed[:, i2]
+        # Fold the bits of every value onto its lowest bit, which is then set if the values differ
+        folded = differ.copy()
+        for shift in range(1, self.bits):
+            folded |= differ >> shift
+        folded &= sum(1 << k * self.bits for k in range(8 // self.bits))
+        # The padding values of the last byte are 0 in every column, so they never differ
+        equal = 1 - POPCOUNT[folded].sum(axis=0, dtype=np.int64) / self.num_hashes
+        chance = 2.0**-self.bits
+        return np.clip((equal - chance) / (1 - chance), 0, 1)
+
+
+def precompute_signatures(data, num_const=105, num_mult=11, R=2*3*5*7*11*13*17+19, scheme='minhash', token_seed=None, cache_dir=None, indices=None, bits=None, *args, **kwargs):
+    """
+    Compute the signature matrix of the products in data, or load it from the signature cache in cache_dir (None, the default, to not use the cache).
+    With indices, only the columns of the products at these indices into the flattened products of data are returned.
+    With bits, the signatures are packed to the lowest bits of every value (see pack_signatures), also in the cache.
+    """
+    if indices is not None and token_seed is not None:
+        # Stable token hashes do not depend on the other products, so the columns are taken from the signatures of all products
+        return precompute_signatures(data, num_const, num_mult, R, scheme, token_seed, cache_dir, bits=bits)[:, indices]
+
+    def compute():
+        products = [product for products in list(data.values()) for product in products]
+        if indices is not None:
+            products = [products[k] for k in indices]
+
+        signatures = compute_signatures(intern_sets(get_words(product) for product in products), num_const, num_mult, R, scheme, token_seed)
+        return signatures if bits is None else pack_signatures(signatures, bits)
+
+    return cached_signatures(data, compute, cache_dir, indices=indices, num_const=num_const, num_mult=num_mult, R=R, scheme=scheme, token_seed=token_seed, bits=bits)
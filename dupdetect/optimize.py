@@ -1,10 +1,18 @@
 import os
 import json
+import math
 import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-from detect import detect
+from detect import detect, prepare, product_table, model_id_candidates, lsh_candidates
 from minhashing import precompute_signatures, possible_bands
+from compare import brand_codes, brand_conflicts, signature_agreement
+from similarity import jaccard_pairs
+from evaluate import evaluate, grade, model_id_codes
+from metrics import Metrics
 
 random.seed(123)
 
@@ -14,112 +22,380 @@ def bootstrap_from_file(file, *args, **kwargs):
     data = json.load(open(file, 'r'))
     return bootstrap(data, *args, **kwargs)
 
-def bootstrap(data):
-    # Unpack products
-    products = [product for products in list(data.values()) for product in products]
+def group_by_model_id(products, indices):
+    """
+    Convert the products at the given indices to a dictionary in the original data format.
+    Returns the dictionary and the indices in the order in which the products appear in it.
+    """
+    groups = {}
+    for k in indices:
+        mid = products[k]['modelID']
+        if mid in groups:
+            groups[mid].append(k)
+        else:
+            groups[mid] = [k]
+    order = np.array([k for ks in groups.values() for k in ks], dtype=np.int64)
+    return {mid: [products[k] for k in ks] for mid, ks in groups.items()}, order
+
+def bootstrap_indices(num_products, rng=np.random):
+    """
+    Draw a bootstrap of num_products products and its out-of-bag sample as sorted index arrays, using boolean masks.
+    As the products of a modelID are adjacent in the flattened data, the indices are also grouped by modelID.
+    The sample is drawn with rng (a np.random.RandomState), which defaults to the global numpy random state.
+    """
     # Select part of the products
-    # bootstrap = random.choices(products, k=len(products))
     # Only use doubly-samples products once!
-    bootstrap_indices = np.unique(np.random.randint(low=0, high=len(products), size=len(products)))
-    bootstrap = [products[k] for k in bootstrap_indices]
-
-    # Obtain out of bag products
-    out_of_bag = [p for p in products if p not in bootstrap]
+    in_bag = np.zeros(num_products, dtype=bool)
+    in_bag[rng.randint(low=0, high=num_products, size=num_products)] = True
+    return np.flatnonzero(in_bag), np.flatnonzero(~in_bag)
+
+def bootstrap(data, return_indices=False, rng=np.random):
+    """
+    Draw a bootstrap and its out-of-bag sample from data, both in the original data format.
+    With return_indices, also return the indices of their products into the flattened products of data,
+    in the order of the returned dictionaries. These select the columns of a signature matrix for data.
+    The sample is drawn with rng (see bootstrap_indices).
+    """
+    # Unpack products
+    products = [product for products in list(data.values()) for product in products]
+    in_bag, out_of_bag = bootstrap_indices(len(products), rng)
 
     # Convert to dictionaries in the original data format
-    bootstrap_dict = {}
-    for p in bootstrap:
-        mid = p['modelID']
-        if mid in bootstrap_dict:
-            bootstrap_dict[mid].append(p)
-        else:
-            bootstrap_dict[mid] = [p]
-
-    out_of_bag_dict = {}
-    for p in out_of_bag:
-        mid = p['modelID']
-        if mid in out_of_bag_dict:
-            out_of_bag_dict[mid].append(p)
-        else:
-            out_of_bag_dict[mid] = [p]
+    bootstrap_dict, bootstrap_order = group_by_model_id(products, in_bag)
+    out_of_bag_dict, out_of_bag_order = group_by_model_id(products, out_of_bag)
 
+    if return_indices:
+        return (bootstrap_dict, out_of_bag_dict, bootstrap_order, out_of_bag_order)
     return (bootstrap_dict, out_of_bag_dict)
 
 
-def train(data):
+def pair_features(flat_products, words, signatures, pair_keys, max_threshold=1.0):
+    """
+    Compute for every candidate pair (as pair keys, see lsh.bucket_pairs) what compare.is_duplicate checks:
+    whether the brands conflict, the fraction of equal signature values and the Jaccard similarity of the compared word sets words (see compare.compare_sets).
+    The similarity is only computed where it can decide for a threshold up to max_threshold, and 0 elsewhere.
+    Returns the three arrays aligned with pair_keys.
+    """
+    i1, i2 = np.divmod(pair_keys, len(flat_products))
+
+    brand_conflict = brand_conflicts(brand_codes(flat_products), i1, i2)
+    agreement = signature_agreement(signatures, i1, i2)
+
+    similarity = np.zeros(len(pair_keys))
+    undecided = agreement < max_threshold
+    similarity[undecided] = jaccard_pairs(words, i1[undecided], i2[undecided])
+    return brand_conflict, agreement, similarity
+
+
+def sweep(data, compare_sims=np.linspace(0, 1, 11), n=1155, bands=None, metrics=None, **kwargs):
+    """
+    Evaluate detect for every band configuration of possible_bands(n) (or the given subset bands of it) and every compare similarity in compare_sims at once.
+    The products are prepared and the signatures computed once, the candidates are generated once per band configuration
+    and the features of every candidate pair are computed once, after which every compare similarity is a vectorized comparison.
+    Returns the same list of (r, b, threshold, performance, compare_sim) as detect would give in train.
+    The stages are measured in metrics (see metrics.Metrics). Other keyword arguments are passed to detect.prepare.
+    """
+    metrics = metrics or Metrics()
+    flat_products, product_sets, words, data_stats, signatures = prepare(data, metrics=metrics, **kwargs)
+    num_products = data_stats['n']
+    if bands is None:
+        bands = possible_bands(n)
+
+    mid_candidates = model_id_candidates(product_sets, metrics)
+    band_candidates = [lsh_candidates(signatures, r, b, mid_candidates, metrics) for (r, b, threshold) in bands]
+
+    # Compute the features and labels of every pair once
+    with metrics.stage('classify'):
+        all_candidates = np.unique(np.concatenate([mid_candidates, *band_candidates]))
+        brand_conflict, agreement, similarity = pair_features(flat_products, words, signatures, all_candidates, max(compare_sims))
+    metrics.count('model_id_candidates', len(mid_candidates))
+    metrics.count('all_candidates', len(all_candidates))
+
+    codes = model_id_codes(flat_products)
+    i1, i2 = np.divmod(all_candidates, num_products)
+
+    # Model ID candidates are classified with threshold 0.0 without brand check
+    mid = np.searchsorted(all_candidates, mid_candidates)
+    mid_pred = (agreement[mid] >= 0.0) | (similarity[mid] > 0.0)
+
+    results = []
+    for (r, b, threshold), candidates in zip(bands, band_candidates):
+        pair_indices = np.concatenate([np.searchsorted(all_candidates, candidates), mid])
+        cand = pair_indices[:len(candidates)]
+        for compare_sim in compare_sims:
+            with metrics.stage('evaluate'):
+                pred = ~brand_conflict[cand] & ((agreement[cand] >= compare_sim) | (similarity[cand] > compare_sim))
+                conf_mat, pair_perf = grade(codes, i1[pair_indices], i2[pair_indices], np.concatenate([pred, mid_pred]), data_stats['Nd'], num_products)
+                performance = evaluate(**conf_mat, **pair_perf, num_real_duplicates=data_stats['Nd'], num_products=num_products)
+            results.append((r, b, threshold, performance, compare_sim))
+        metrics.log('r: {} - b: {} - candidates: {} - best F1: {}'.format(r, b, len(pair_indices), max(res[3]['F1'] for res in results[-len(compare_sims):])))
+    return results
+
+
+def successive_halving(data, indices, signatures, bands=None, compare_sims=np.linspace(0, 1, 11), groups=None, eta=3, rungs=3, rng=np.random, metrics=None, **kwargs):
+    """
+    Adaptive alternative to a sweep over all band configurations, by successive halving (Jamieson and Talwalkar,
+    Non-stochastic best arm identification and hyperparameter optimization): all band configurations of bands (default
+    possible_bands(1155)) are swept on a random eta^-(rungs-1) of the products at indices, after which only the best 1/eta
+    (by their best F1 over compare_sims) are swept again on eta times as many products, up to all of them in the last rung.
+    The samples are nested and drawn with rng (see bootstrap_indices). With groups (the model ID group of every product at
+    indices, see detect.product_table), whole groups are sampled, such that the sampled products keep their duplicates
+    and F1 is less noisy on small samples. As the number of pairs grows quadratically with the sample, the configurations
+    that are eliminated early cost little.
+    signatures holds the columns of the products at indices. Other keyword arguments are passed to detect.prepare.
+    Returns the results of sweep for every band configuration from the largest sample it was evaluated on, in the order of
+    bands. The fraction of the products in that sample is recorded as 'sample_fraction' in the performance.
+    """
+    metrics = metrics or Metrics()
+    bands = possible_bands(1155) if bands is None else bands
+    if groups is None:
+        order = rng.permutation(len(indices))
+    else:
+        _, group = np.unique(groups, return_inverse=True)
+        order = np.lexsort((np.arange(len(indices)), rng.permutation(group.max() + 1)[group]))
+    latest = {}
+    alive = list(bands)
+    for rung in range(rungs):
+        fraction = eta**(rung - rungs + 1)
+        positions = np.sort(order[:max(2, round(fraction * len(indices)))])
+        metrics.log('Rung {}: {} band configurations on {} products'.format(rung, len(alive), len(positions)))
+        results = sweep(data, compare_sims, bands=alive, pre_comp_signature=signatures[:, positions], indices=indices[positions], metrics=metrics, **kwargs)
+        scores = []
+        for k, band in enumerate(alive):
+            latest[band] = results[k*len(compare_sims):(k+1)*len(compare_sims)]
+            for res in latest[band]:
+                res[3]['sample_fraction'] = fraction
+            scores.append(max(res[3]['F1'] for res in latest[band]))
+        best = sorted(sorted(range(len(alive)), key=lambda k: -scores[k])[:math.ceil(len(alive) / eta)])
+        alive = [alive[k] for k in best]
+    return [res for band in bands for res in latest[band]]
+
+
+# State of a (worker) process running the tasks of train and test, see start_worker
+worker = {}
+
+def start_worker(data, signature_file, seed, scheme, cache_dir, quiet=False):
+    """
+    Initialize a process for running train_task and test_task. The products are cleaned once into a product table
+    from which the bootstraps select by index. The signatures are memory-mapped from signature_file
+    (if given), such that all workers share the same pages instead of receiving a copy.
+    """
+    worker['data'] = data
+    worker['table'] = product_table(data)
+    worker['signatures'] = np.load(signature_file, mmap_mode='r') if signature_file is not None else None
+    worker['seed'] = seed
+    worker['scheme'] = scheme
+    worker['cache_dir'] = cache_dir
+    worker['quiet'] = quiet
+
+def draw_bootstrap(n_bootstrap):
+    """
+    Draw bootstrap n_bootstrap of the worker data as index arrays (see bootstrap_indices). Every bootstrap has its own
+    random state derived from the seed, so it is the same regardless of the process or order in which it is drawn.
+    """
+    return bootstrap_indices(len(worker['table'][0]), rng=np.random.RandomState(worker['seed'] + n_bootstrap))
+
+def bootstrap_signatures(indices):
+    """
+    The signatures of the worker products at indices, the columns of the shared signatures if there are any.
+    """
+    if worker['signatures'] is not None:
+        return worker['signatures'][:, indices]
+    return precompute_signatures(worker['data'], scheme=worker['scheme'], cache_dir=worker['cache_dir'], indices=indices)
+
+def run_tasks(task, args, workers, *initargs):
+    """
+    Run task for every argument tuple in args, in a pool of the given number of worker processes or in this process if workers is 1.
+    Returns the results in the order of args. If a worker process dies (for instance killed for lack of memory), the
+    pool is broken and concurrent.futures.process.BrokenProcessPool is raised instead of waiting for its tasks forever.
+    """
+    if workers <= 1:
+        start_worker(*initargs)
+        return [task(*arg) for arg in args]
+    with ProcessPoolExecutor(workers, initializer=start_worker, initargs=initargs) as executor:
+        futures = [executor.submit(task, *arg) for arg in args]
+        return [future.result() for future in futures]
+
+def shared_signatures(data, scheme, token_seed, cache_dir):
+    """
+    Compute the signatures of all products of data once (or find them in the signature cache) for memory-mapping by the workers.
+    Returns the file name, or None if signatures have to be computed per bootstrap (token_seed None), and whether the
+    file is a temporary file of this run, which the caller removes with remove_signatures once the workers are done.
+    """
+    if token_seed is None:
+        return None, False
+    signatures = precompute_signatures(data, scheme=scheme, token_seed=token_seed, cache_dir=cache_dir)
+    if isinstance(signatures, np.memmap):
+        return signatures.filename, False
+    # The cache is disabled or too small to hold them: a file of its own, so concurrent runs do not overwrite each other's
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    fd, signature_file = tempfile.mkstemp(prefix='signature-', suffix='.npy', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as fp:
+        np.save(fp, signatures)
+    return signature_file, True
+
+def remove_signatures(signature_file, temporary):
+    """
+    Remove the signature file of shared_signatures if it is temporary, after releasing its memory map in this process.
+    """
+    worker.pop('signatures', None)
+    if temporary:
+        os.remove(signature_file)
+
+
+def train_task(n_bootstrap, bands, search='grid'):
+    """
+    Run the sweep over the given band configurations on bootstrap n_bootstrap, or with search 'halving' the successive halving.
+    """
+    Metrics(quiet=worker['quiet']).log('Bootstrap: {}\n'.format(n_bootstrap))
+    # Draw bootstraps 
+    in_bag, _ = draw_bootstrap(n_bootstrap)
+
+    # Pre-compute signature to save CPU time
+    pre_comp_signature = bootstrap_signatures(in_bag)
+
+    # Perform optimization over the (r, b) and compare_sim, given a lsh_sim. 
+    if search == 'halving':
+        # The samples of every bootstrap are seeded by the bootstrap, like the bootstrap itself
+        rng = np.random.RandomState([worker['seed'], n_bootstrap])
+        return successive_halving(worker['data'], in_bag, pre_comp_signature, bands, groups=worker['table'][4][in_bag], rng=rng, table=worker['table'], metrics=Metrics(quiet=worker['quiet']))
+    return sweep(worker['data'], compare_sims=np.linspace(0, 1, 11), n=1155, bands=bands, pre_comp_signature=pre_comp_signature, indices=in_bag, table=worker['table'], metrics=Metrics(quiet=worker['quiet']))
+
+
+def train(data, scheme='minhash', token_seed=0, workers=1, seed=123, cache_dir=None, quiet=False, search='grid'):
+    """
+    Optimize the settings on 5 bootstraps of data. With a token_seed (see minhashing.token_hash) the signatures are
+    computed once for the whole dataset and every bootstrap takes its columns. With token_seed None they are computed per bootstrap.
+    The bootstraps, and with shared signatures also groups of band configurations, are run in a pool of workers processes.
+    The results do not depend on the number of workers. Signatures are taken from the signature cache in cache_dir if it is given.
+    With quiet, the progress of the stages of the bootstraps is not printed.
+    With search 'halving', the band configurations are searched adaptively on samples of every bootstrap (see
+    successive_halving) instead of all on the full bootstrap; the results have the same form, so test works on both.
+    """
     random.seed(123)
+    os.makedirs('results', exist_ok=True)
 
-    # Initialize list of (bootstrap, out-of-bag) samples
-    boots = []
-
-    boot_results = []
-
-    for n_bootstrap in range(1, 6): # Perform 5 bootstraps
-
-        print('Bootstrap: {}\n'.format(n_bootstrap))
-        # Draw bootstraps 
-        bootstrap_dict, out_of_bag_dict = bootstrap(data)
-        boots.append((bootstrap_dict, out_of_bag_dict))
-
-        # Pre-compute signature to save CPU time
-        pre_comp_signature = precompute_signatures(bootstrap_dict)
-        
-        # Ensure the proper directories are created
-        cache_f = 'cache/signature-bootstrap-{}.npy'.format(n_bootstrap)
-        os.makedirs(os.path.dirname(cache_f), exist_ok=True)
-        os.makedirs('results', exist_ok=True)
-        np.save(cache_f, pre_comp_signature)
-
-        # Perform optimization
-        results = []
-        n = 1155
-        for (r,b,threshold) in possible_bands(n):
-            for compare_sim in np.linspace(0, 1, 11):  # Optimize over compare_sim, given a lsh_sim. 
+    signature_file, temporary = shared_signatures(data, scheme, token_seed, cache_dir)
 
-                performance = detect(bootstrap_dict, lsh_similarity=threshold, compare_similarity=compare_sim,pre_comp_signature=pre_comp_signature)
-                results.append((r,b,threshold, performance, compare_sim))
+    # Split the band configurations over the workers if there are more workers than bootstraps
+    bands = possible_bands(1155)
+    num_splits = max(1, workers // 5) if signature_file is not None and search == 'grid' else 1
+    args = [(n_bootstrap, bands[k::num_splits], search) for n_bootstrap in range(1, 6) for k in range(num_splits)] # Perform 5 bootstraps
+    try:
+        task_results = run_tasks(train_task, args, workers, data, signature_file, seed, scheme, cache_dir, quiet)
+    finally:
+        remove_signatures(signature_file, temporary)
 
+    boot_results = []
+    for n_bootstrap in range(1, 6):
+        # Put the results of the band configurations back in the order of possible_bands
+        results = [res for (n_boot, *_), task_result in zip(args, task_results) if n_boot == n_bootstrap for res in task_result]
+        results = sorted(results, key=lambda res: [band[0] for band in bands].index(res[0]))
 
         json.dump(results, open('results/bootstrap-{}-results.json'.format(n_bootstrap), 'w'))
         boot_results.append(results)
     return boot_results
 
 
-def test(data, boot_results, optimality_metric='F1', load_from_dir=None):
-    random.seed(123)
+def test_task(n_bootstrap, boot_results, optimality_metric):
+    """
+    Evaluate the best settings per lsh_similarity of boot_results on the out-of-bag sample of bootstrap n_bootstrap.
+    Band configurations that successive halving eliminated on a sample (a 'sample_fraction' below 1) are skipped, as
+    their compare similarity was not tuned on the full bootstrap.
+    """
+    Metrics(quiet=worker['quiet']).log('Bootstrap: {}\n'.format(n_bootstrap))
+    # Draw bootstraps 
+    _, out_of_bag = draw_bootstrap(n_bootstrap)
+    pre_comp_signature = bootstrap_signatures(out_of_bag)
 
-    # Initialize list of (bootstrap, out-of-bag) samples
-    boots = []
     eval_results = []
+    n = 1155
+    for (r,b,threshold) in possible_bands(n):
 
+        # Perform optimization
+        settings = [res for res in boot_results if res[2] == threshold and res[3].get('sample_fraction', 1) == 1]
+        if not settings:
+            continue
+        best_settings = settings[np.argmax([res[3][optimality_metric] for res in settings])]
+        eval = detect(worker['data'], lsh_similarity=threshold, compare_similarity=best_settings[4], pre_comp_signature=pre_comp_signature, scheme=worker['scheme'], indices=out_of_bag, table=worker['table'], metrics=Metrics(quiet=worker['quiet']))
+        eval_results.append((*best_settings[0:3], best_settings[4], eval))
+    return eval_results
 
-    for n_bootstrap in range(1, 6): # Perform 5 bootstraps
 
-        print('Bootstrap: {}\n'.format(n_bootstrap))
-        # Draw bootstraps 
-        bootstrap_dict, out_of_bag_dict = bootstrap(data)
-        boots.append((bootstrap_dict, out_of_bag_dict))
+def test(data, boot_results, optimality_metric='F1', load_from_dir=None, scheme='minhash', token_seed=0, workers=1, seed=123, cache_dir=None, quiet=False):
+    """
+    Evaluate the best settings per lsh_similarity from training on the out-of-bag samples of the same 5 bootstraps.
+    Settings from successive halving that were only tuned on a sample of a bootstrap are not evaluated (see test_task).
+    The token_seed and seed should be the ones used for training, the signatures are then computed once for the whole dataset.
+    The bootstraps are evaluated in a pool of workers processes. Signatures are taken from the signature cache in cache_dir if it is given.
+    With quiet, only the average performance is printed.
+    """
+    random.seed(123)
+
+    signature_file, temporary = shared_signatures(data, scheme, token_seed, cache_dir)
 
+    args = []
+    for n_bootstrap in range(1, 6): # Perform 5 bootstraps
         if load_from_dir is not None:
             boot_results = json.load(open(load_from_dir + '/bootstrap-{}-results.json'.format(n_bootstrap), 'r'))
+        args.append((n_bootstrap, boot_results, optimality_metric))
 
-        n = 1155
-        for (r,b,threshold) in possible_bands(n):
-
-            # Perform optimization
-            best_setting_index = np.argmax([r[3][optimality_metric] for r in boot_results if r[2] == threshold])
-            best_settings = [r for r in boot_results if r[2] == threshold][best_setting_index]
-            eval = detect(out_of_bag_dict, lsh_similarity=threshold, compare_similarity=best_settings[4])
-            eval_results.append((*best_settings[0:3], best_settings[4], eval))
+    try:
+        eval_results = [res for task_result in run_tasks(test_task, args, workers, data, signature_file, seed, scheme, cache_dir, quiet) for res in task_result]
+    finally:
+        remove_signatures(signature_file, temporary)
  
     os.makedirs('results', exist_ok=True)
     json.dump(eval_results, open('results/oob-results.json', 'w'))
+    n = 1155
     for (r,b,threshold) in possible_bands(n):
-        print('Average Performance for lsh_similarity {}:\n'.format(threshold))
+        num_evaluated = sum(1 for res in eval_results if res[2] == threshold)
+        if num_evaluated == 0:
+            print('lsh_similarity {}: not evaluated, successive halving only tuned it on samples of the bootstraps\n'.format(threshold))
+            continue
+        print('Average Performance for lsh_similarity {}{}:\n'.format(threshold, '' if num_evaluated == 5 else ' (over the {} of 5 bootstraps that tuned it fully)'.format(num_evaluated)))
         avg_perf = average_performance(eval_results, threshold)
         print('\n'.join(['{:>22}: {}'.format(k,v) for k, v in avg_perf.items()]))
     return eval_results
 
+def compare_schemes(data, schemes=('minhash', 'oph'), compare_similarity=0.999, seed=123, cache_dir=None):
+    """
+    Compare the accuracy and signature cost of the signature schemes on the same bootstraps.
+    The bootstraps are seeded per bootstrap from seed, the same ones as those of train with that seed (see draw_bootstrap).
+    For every bootstrap the signatures are computed once per scheme (or taken from the signature cache in cache_dir if it is given)
+    and all band configurations are evaluated.
+    Writes results/scheme-results.json as a list of (scheme, r, b, threshold, performance, signature_seconds).
+    """
+    table = product_table(data)
+
+    results = []
+    for n_bootstrap in range(1, 6): # Perform 5 bootstraps
+
+        print('Bootstrap: {}\n'.format(n_bootstrap))
+        in_bag, out_of_bag = bootstrap_indices(len(table[0]), rng=np.random.RandomState(seed + n_bootstrap))
+
+        for scheme in schemes:
+            start = time.perf_counter()
+            pre_comp_signature = precompute_signatures(data, scheme=scheme, cache_dir=cache_dir, indices=in_bag)
+            seconds = time.perf_counter() - start
+
+            n = 1155
+            for (r,b,threshold) in possible_bands(n):
+                performance = detect(data, lsh_similarity=threshold, compare_similarity=compare_similarity, pre_comp_signature=pre_comp_signature, indices=in_bag, table=table)
+                results.append((scheme, r, b, threshold, performance, seconds))
+
+    os.makedirs('results', exist_ok=True)
+    json.dump(results, open('results/scheme-results.json', 'w'))
+
+    for scheme in schemes:
+        scheme_results = [res for res in results if res[0] == scheme]
+        print('Scheme {}: average signature time {:.3f}s'.format(scheme, sum(res[5] for res in scheme_results)/len(scheme_results)))
+        for (r,b,threshold) in possible_bands(n):
+            perfs = [res[4] for res in scheme_results if res[3] == threshold]
+            print('{:>6} r: {:>4} - b: {:>4} - F1: {:.4f} - PC: {:.4f} - PQ: {:.4f}'.format(scheme, r, b, *[sum(p[k] for p in perfs)/len(perfs) for k in ('F1', 'PC', 'PQ')]))
+    return results
+
 def average_performance(eval_results, lsh_similarity):
     # Map to performance metrics
     eval_performances = [r[4] for r in eval_results if r[2] == lsh_similarity]
@@ -0,0 +1,102 @@
+# Band-sharded LSH candidate generation
+#
+# The bands of LSH are independent, as a bucket only holds the products of one band. The bands are dealt round-robin
+# over shards and every shard is bucketed and expanded into sorted unique pair keys by a worker process, after which the
+# sorted keys of all shards are merged. The union over the shards is exactly the serial result of lsh.band_buckets and
+# lsh.bucket_pairs (or blocking.blocked_bucket_pairs).
+# Dealing the bands round-robin instead of in consecutive ranges spreads the cost better, as the first bands of the
+# signatures tend to hold the largest buckets. A band with a giant bucket still bounds the speedup, however.
+# The workers read the signature matrix from shared memory, or from a .npy file, instead of receiving a copy per task.
+# A task only holds the description of the signatures, its bands and the arrays for blocking, so any executor with a
+# map(function, tasks) method can run them, such as a concurrent.futures.ProcessPoolExecutor (the default), which raises
+# BrokenProcessPool if a worker dies instead of waiting for its tasks, or a multiprocessing.Pool.
+# A cluster executor with the same method runs the same tasks across nodes, given a .npy file on storage they share.
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from blocking import blocked_bucket_pairs
+from lsh import band_buckets, bucket_pairs, bucket_sizes, union_runs
+from minhashing import PackedSignatures
+
+
+def share(signatures):
+    """
+    Copy signatures into a new SharedMemory block. Returns the block, which the caller closes and unlinks when the workers
+    are done, and the description of the signatures that attach takes.
+    """
+    shm = SharedMemory(create=True, size=max(signatures.nbytes, 1))
+    np.ndarray(signatures.shape, dtype=signatures.dtype, buffer=shm.buf)[:] = signatures
+    return shm, ('shm', shm.name, signatures.shape, signatures.dtype.str)
+
+def attach(source):
+    """
+    The signatures described by source: ('shm', name, shape, dtype) of share or ('file', name) of a .npy file, which is
+    memory-mapped. Returns the signatures and the SharedMemory block to close when done (None for a file).
+    """
+    if source[0] == 'file':
+        return np.load(source[1], mmap_mode='r'), None
+    _, name, shape, dtype = source
+    shm = SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def shard_pairs(task):
+    """
+    Bucket the bands of a shard of the signatures and generate the pairs of their buckets, as a worker does.
+    task is (source, r, bands, shops, brands), with the indices of the bands of the shard; see attach and
+    blocking.blocked_bucket_pairs (shops None for no blocking).
+    Returns the sorted unique pair keys, the frequencies of the bucket sizes (as np.bincount) and the blocking statistics (or None).
+    """
+    source, r, bands, shops, brands = task
+    signatures, shm = attach(source)
+    try:
+        products, starts = band_buckets(signatures[(bands[:, None] * r + np.arange(r)).ravel()], r=r, b=len(bands))
+    finally:
+        del signatures
+        if shm is not None:
+            shm.close()
+    num_products = len(products) // len(bands)
+    frequencies = np.bincount(bucket_sizes(products, starts))
+    if shops is None:
+        return bucket_pairs(products, starts, num_products), frequencies, None
+    pair_keys, stats = blocked_bucket_pairs(products, starts, num_products, shops, brands)
+    return pair_keys, frequencies, stats
+
+
+def band_pairs(signatures, r, b, workers=2, shops=None, brands=None, executor=None, num_shards=None):
+    """
+    Generate the pairs of products sharing an LSH bucket in any of the b bands of r rows, with the bands sharded over
+    workers processes (or the tasks of executor). signatures is the n x p signature matrix (or its minhashing.PackedSignatures,
+    whose b-bit values are shared), which is shared through shared memory, or the name of a .npy file holding it.
+    The bands are dealt round-robin over num_shards (default workers) shards.
+    Returns the sorted unique pair keys, the frequencies of the bucket sizes and the blocking statistics summed over the
+    shards (None without shops), the same as the serial path gives.
+    """
+    shm = None
+    if isinstance(signatures, str):
+        source = ('file', signatures)
+    else:
+        shm, source = share(signatures.values() if isinstance(signatures, PackedSignatures) else signatures)
+    try:
+        num_shards = min(b, num_shards or workers)
+        tasks = [(source, r, np.arange(k, b, num_shards), shops, brands) for k in range(num_shards)]
+        if executor is not None:
+            results = list(executor.map(shard_pairs, tasks))
+        elif workers <= 1:
+            results = [shard_pairs(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(min(workers, len(tasks))) as executor:
+                results = list(executor.map(shard_pairs, tasks))
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    pair_keys = union_runs(keys for keys, _, _ in results)
+    frequencies = np.zeros(max(len(freq) for _, freq, _ in results), dtype=np.int64)
+    for _, freq, _ in results:
+        frequencies[:len(freq)] += freq
+    stats = None if shops is None else {name: sum(res[2][name] for res in results) for name in results[0][2]}
+    return pair_keys, frequencies, stats
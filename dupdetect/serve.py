@@ -0,0 +1,222 @@
+# Duplicate lookup service on top of a prebuilt LSHIndex
+#
+# Requests are JSON objects {"product": {...}, "id": ..., "add": false, "key": ...} (or just a product) and are answered
+# with {"id": ..., "duplicates": [{"key": ..., "similarity": ...}, ...]}. With "add" the product is added to the index
+# after the lookup, under "key" if given. Requests are read as JSON Lines from stdin or received over local HTTP.
+# All requests are handled by a single thread, which takes every request that is waiting as one batch and signs it at once.
+import json
+import queue
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from index import LSHIndex
+
+
+def build_index(file, index_file, **kwargs):
+    """
+    Build an LSHIndex of all products in a product file (see ingest.iter_products) and save it to index_file.
+    The key of every product is its position in the file. Other keyword arguments are passed to LSHIndex.
+    """
+    from ingest import iter_products
+    index = LSHIndex(**kwargs)
+    index.extend(iter_products(file))
+    index.save(index_file)
+    return index
+
+
+def sign_batch(index, products):
+    """
+    The signatures and band keys of a batch of products, computed at once (see LSHIndex.sign and LSHIndex.band_keys)
+    as lists with an entry per product. If the batch fails, every product is signed alone, such that only the products
+    that cannot be signed fail: their signature is None and their band keys the exception.
+    """
+    if not products:
+        return [], []
+    try:
+        signatures = index.sign(products)
+        lsh_keys = index.band_keys(signatures)
+        return list(signatures.T), list(lsh_keys.T)
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        if len(products) <= 1:
+            return [None] * len(products), [e] * len(products)
+    signatures, lsh_keys = [], []
+    for product in products:
+        signature, keys = sign_batch(index, [product])
+        signatures += signature
+        lsh_keys += keys
+    return signatures, lsh_keys
+
+
+def handle_batch(index, requests):
+    """
+    Answer a batch of requests (see the module description), signing all their products at once (see sign_batch).
+    A request that cannot be answered gets a response with an error message instead.
+    """
+    responses = [None] * len(requests)
+    products = []
+    for k, request in enumerate(requests):
+        if not isinstance(request, dict) or not isinstance(request.get('product', request), dict):
+            responses[k] = {'error': 'A request must be a JSON object with a product'}
+            continue
+        product = request.get('product', request)
+        if 'title' not in product:
+            responses[k] = {'id': request.get('id'), 'error': 'The product has no title'}
+            continue
+        if not isinstance(product['title'], str):
+            responses[k] = {'id': request.get('id'), 'error': 'The title of the product is not a string'}
+            continue
+        products.append((k, product))
+
+    signatures, lsh_keys = sign_batch(index, [product for k, product in products])
+    for column, (k, product) in enumerate(products):
+        request = requests[k]
+        if signatures[column] is None:
+            responses[k] = {'id': request.get('id'), 'error': 'Invalid product: {!r}'.format(lsh_keys[column])}
+            continue
+        try:
+            entry = index.entry(product, signatures[column], lsh_keys[column])
+            duplicates = index.matches(entry)
+            responses[k] = {'id': request.get('id'), 'duplicates': [{'key': key, 'similarity': similarity} for key, similarity in duplicates]}
+            if request.get('add'):
+                responses[k]['key'] = index.add(product, request.get('key'), signatures[column], lsh_keys[column])
+        except (KeyError, TypeError, AttributeError) as e:
+            responses[k] = {'id': request.get('id'), 'error': 'Invalid product: {!r}'.format(e)}
+    return responses
+
+
+class Batcher:
+    """
+    Hands the requests of concurrent callers to a single worker thread, which answers all waiting requests as one batch.
+    Batches form by themselves under load, without delaying a request when the service is idle.
+    """
+    def __init__(self, index, max_batch=256):
+        self.index = index
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, request):
+        """
+        Answer a request, blocking until its batch is handled.
+        """
+        slot = {'request': request, 'done': threading.Event()}
+        self.queue.put(slot)
+        slot['done'].wait()
+        return slot['response']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                responses = handle_batch(self.index, [slot['request'] for slot in batch])
+            except Exception as e:
+                responses = [{'error': 'Internal error: {!r}'.format(e)}] * len(batch)
+            for slot, response in zip(batch, responses):
+                slot['response'] = response
+                slot['done'].set()
+
+
+def serve_lines(index, infile=sys.stdin, outfile=sys.stdout, max_batch=256):
+    """
+    Answer the JSON Lines requests of infile on outfile, one response line per request line, in order.
+    A reader thread queues the lines as they arrive and all lines that are waiting (up to max_batch) are answered as
+    one batch (see handle_batch), so a file or pipe of many requests is signed in batches, while a single interactive
+    request is answered at once.
+    """
+    lines = queue.Queue()
+
+    def read():
+        for line in infile:
+            if line.strip():
+                lines.put(line)
+        lines.put(None)  # End of the input
+    threading.Thread(target=read, daemon=True).start()
+
+    done = False
+    while not done:
+        batch = [lines.get()]
+        while batch[-1] is not None and len(batch) < max_batch:
+            try:
+                batch.append(lines.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            done = True
+            batch.pop()
+
+        responses = [None] * len(batch)
+        requests = []
+        for k, line in enumerate(batch):
+            try:
+                requests.append((k, json.loads(line)))
+            except json.JSONDecodeError as e:
+                responses[k] = {'error': 'Invalid JSON: {}'.format(e)}
+        for (k, request), response in zip(requests, handle_batch(index, [request for k, request in requests])):
+            responses[k] = response
+        if responses:
+            outfile.write(''.join(json.dumps(response) + '\n' for response in responses))
+            outfile.flush()
+
+
+class LookupServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Accept bursts of new connections
+
+
+def serve_http(index, port=8000, host='127.0.0.1', max_batch=256):
+    """
+    Answer requests POSTed as JSON to http://host:port/ until interrupted. GET / returns the number of indexed products.
+    """
+    batcher = Batcher(index, max_batch)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep connections alive
+        disable_nagle_algorithm = True  # Do not hold back the body of a response waiting for an acknowledgement
+
+        def reply(self, status, response):
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply(200, {'products': len(index)})
+
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except (ValueError, json.JSONDecodeError) as e:
+                return self.reply(400, {'error': 'Invalid JSON: {}'.format(e)})
+            response = batcher.submit(request)
+            self.reply(400 if 'error' in response else 200, response)
+
+        def log_message(self, format, *args):
+            pass  # No line per request on stderr
+
+    server = LookupServer((host, port), Handler)
+    print('Serving duplicate lookups of {} products on http://{}:{}/'.format(len(index), host, server.server_port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def serve(index_file, port=None, **kwargs):
+    """
+    Load the LSHIndex in index_file and answer requests over HTTP on port, or as JSON Lines on stdin/stdout if port is None.
+    """
+    index = LSHIndex.load(index_file)
+    if port is None:
+        serve_lines(index)
+    else:
+        serve_http(index, port, **kwargs)
@@ -1,2 +1,22 @@
+import numpy as np
+
+from tokens import intersection_sizes
+
+
 def jaccard(set1, set2):
-    return len(set1.intersection(set2)) / len(set1.union(set2))
\ No newline at end of file
+    return len(set1.intersection(set2)) / len(set1.union(set2))
+
+
+def jaccard_pairs(token_sets, i1, i2, chunk_size=2**20):
+    """
+    The Jaccard similarity of the token sets (see tokens.TokenSets) of every pair (i1, i2), equal to jaccard of their
+    word sets, and 0 for two empty sets. The pairs are handled in chunks of chunk_size.
+    """
+    sizes = token_sets.sizes()
+    similarity = np.zeros(len(i1))
+    for start in range(0, len(i1), chunk_size):
+        a, b = i1[start:start+chunk_size], i2[start:start+chunk_size]
+        overlap = intersection_sizes(token_sets, a, b)
+        union = sizes[a] + sizes[b] - overlap
+        np.divide(overlap, union, out=similarity[start:start+chunk_size], where=union > 0)
+    return similarity
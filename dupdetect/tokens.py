@@ -0,0 +1,110 @@
+# Token interning
+#
+# Every cleaned word is interned once to an integer token id (see Codes), after which the word sets of the products
+# are stored together in CSR form as sorted int32 token ids (see TokenSets) instead of one Python set of strings per product.
+# Minhashing, the model ID buckets, the similarity join and the Jaccard similarity of candidate pairs read from this structure.
+import numpy as np
+
+
+class Codes:
+    """
+    Interns strings to consecutive integer codes.
+    """
+    def __init__(self, names=()):
+        self.code_of = {}
+        self.names = []
+        for name in names:
+            self(name)
+
+    def __call__(self, name):
+        if name not in self.code_of:
+            self.code_of[name] = len(self.names)
+            self.names.append(name)
+        return self.code_of[name]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class TokenSets:
+    """
+    The word sets of products as token ids of tokens (a Codes) in CSR form: the sorted ids of the words of product k are
+    ids[indptr[k]:indptr[k+1]]. A product costs 4 bytes per word and 8 bytes of offset.
+    """
+    def __init__(self, indptr, ids, tokens):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int32)
+        self.tokens = tokens
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, k):
+        return self.ids[self.indptr[k]:self.indptr[k+1]]
+
+    def sizes(self):
+        return np.diff(self.indptr)
+
+    def words(self, k):
+        """
+        The word set of product k, as strings.
+        """
+        return {self.tokens.names[i] for i in self[k].tolist()}
+
+    def products(self):
+        """
+        The product of every entry of ids.
+        """
+        return np.repeat(np.arange(len(self)), self.sizes())
+
+    def select(self, indices):
+        """
+        The token sets of the products at the given indices, sharing the tokens.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return TokenSets(np.append(0, np.cumsum(self.sizes()[indices])), self.ids[gather(self.indptr, indices)], self.tokens)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.ids.nbytes
+
+
+def gather(indptr, indices):
+    """
+    The positions of the entries of the CSR rows at the given indices, row after row.
+    """
+    lengths = indptr[indices + 1] - indptr[indices]
+    starts = np.cumsum(lengths) - lengths
+    return np.repeat(indptr[indices] - starts, lengths) + np.arange(lengths.sum())
+
+
+def intern_sets(word_sets, tokens=None):
+    """
+    Intern the words of word_sets (iterables of strings) with tokens (a new Codes by default). Returns their TokenSets.
+    """
+    tokens = Codes() if tokens is None else tokens
+    token_lists = [sorted(tokens(word) for word in word_set) for word_set in word_sets]
+    indptr = np.zeros(len(token_lists)+1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in token_lists], out=indptr[1:])
+    ids = np.fromiter((i for ids in token_lists for i in ids), dtype=np.int32, count=indptr[-1])
+    return TokenSets(indptr, ids, tokens)
+
+
+def intersection_sizes(token_sets, i1, i2):
+    """
+    The number of common tokens of every pair of products (i1, i2), by a merge of their sorted token ids.
+    The tokens of every side are laid out pair after pair as keys pair * num_tokens + id, which are sorted as the ids of
+    a product are, such that the keys of one side are found in the other with a single binary search without allocating per pair.
+    """
+    pairs1, keys1 = pair_keys(token_sets, i1)
+    pairs2, keys2 = pair_keys(token_sets, i2)
+    if len(keys2) == 0:
+        return np.zeros(len(i1), dtype=np.int64)
+    found = keys2[np.minimum(np.searchsorted(keys2, keys1), len(keys2) - 1)] == keys1
+    return np.bincount(pairs1[found], minlength=len(i1))
+
+
+def pair_keys(token_sets, products):
+    positions = gather(token_sets.indptr, products)
+    pairs = np.repeat(np.arange(len(products)), token_sets.indptr[products + 1] - token_sets.indptr[products])
+    return pairs, pairs * max(len(token_sets.tokens), 1) + token_sets.ids[positions]
@@ -0,0 +1,5 @@
+# The modules of dupdetect import each other as top-level modules (python dupdetect runs dupdetect/__main__.py)
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dupdetect'))
@@ -0,0 +1,17 @@
+# Blocking on the shop must not break when it leaves no candidate pairs at all
+from benchmark import generate_catalog
+from detect import detect
+from metrics import Metrics
+
+
+def test_single_shop():
+    data = generate_catalog(200, seed=1)
+    for products in data.values():
+        for product in products:
+            product['shop'] = 'amazon.com'
+
+    performance = detect(data, metrics=Metrics(quiet=True), blocking=True)
+    assert performance['num_comparisons'] == 0
+    assert performance['PQ'] == performance['precision'] == performance['F1'] == 0
+    assert performance['recall'] == performance['PC'] == 0
+    assert detect(data, metrics=Metrics(quiet=True))['num_comparisons'] > 0
@@ -0,0 +1,34 @@
+# The incremental index must classify the same pairs as duplicates as detect with the same token seed
+import pytest
+
+import detect
+from benchmark import generate_catalog
+from index import LSHIndex
+from metrics import Metrics
+
+
+@pytest.fixture(scope='module')
+def data():
+    return generate_catalog(300, seed=8)
+
+def predicted_pairs(data, monkeypatch, **kwargs):
+    classifications = []
+    report = detect.report
+    def capture(codes, i1, i2, pred, *args):
+        classifications.append((i1[pred], i2[pred]))
+        return report(codes, i1, i2, pred, *args)
+    monkeypatch.setattr(detect, 'report', capture)
+    detect.detect(data, token_seed=0, metrics=Metrics(quiet=True), **kwargs)
+    i1, i2 = classifications[0]
+    return {(min(p1, p2), max(p1, p2)) for p1, p2 in zip(i1.tolist(), i2.tolist())}
+
+
+@pytest.mark.parametrize('compare_similarity, lsh_similarity', [(0.999, 0.999), (0.6, 0.5), (0.3, 0.8)])
+def test_query_equals_detect(data, monkeypatch, compare_similarity, lsh_similarity):
+    expected = predicted_pairs(data, monkeypatch, compare_similarity=compare_similarity, lsh_similarity=lsh_similarity)
+
+    index = LSHIndex(compare_similarity, lsh_similarity, token_seed=0)
+    keys = index.extend(product for products in data.values() for product in products)
+    pairs = {(min(key, other), max(key, other)) for key in keys for other in index.query(key)}
+    assert len(expected) > 0
+    assert pairs == expected
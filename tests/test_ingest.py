@@ -0,0 +1,60 @@
+# The incremental parser must yield the products of any valid file in the modelID-keyed format, whatever the chunking,
+# and streaming detection must equal detection on the loaded file with the same token seed
+import io
+import json
+
+import pytest
+
+from benchmark import generate_catalog
+from detect import detect, detect_stream
+from ingest import iter_keyed_products, iter_products
+from metrics import Metrics
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    data = generate_catalog(300, seed=5)
+    # Strings that look like the structure of the file, escapes and non-ASCII characters
+    data['odd "key", [x]: {y}'] = [{'title': 'a ] b } c , d : e " \\ é \U0001f4fa', 'shop': 'x', 'url': '', 'featuresMap': {}}, {}]
+    data['empty'] = []
+    return data
+
+def expected(data):
+    return [(key, product) for key, products in data.items() for product in products]
+
+
+@pytest.mark.parametrize('indent', [None, 0, 2])
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096, 2**20])
+def test_keyed_products(catalog, indent, chunk_size):
+    text = json.dumps(catalog, indent=indent, ensure_ascii=indent is None)
+    assert list(iter_keyed_products(io.StringIO(text), chunk_size)) == expected(catalog)
+
+@pytest.mark.parametrize('text', ['{}', ' { } ', '{"a": []}', '\n{\n"a" :\n[ {"b": 1} , {"c": [1, 2]} ]\n,\n"d": [ ]\n}\n'])
+def test_small_files(text):
+    assert list(iter_keyed_products(io.StringIO(text), 1)) == expected(json.loads(text))
+
+@pytest.mark.parametrize('text', ['', '[]', '{"a": [{"b": 1}', '{"a": [{"b": }]}', '{"a" [1]}', '{"a": {"b": 1}}',
+                                  '{"a": [{"b":1} {"c":2}]}', '{,"a": []}', '{"a": [] "b": [{}]}', '{"a": []} trailing',
+                                  '{"a": [1, "x"]}', '{"a": [{"b": 1},]}', '{"a": [,{"b": 1}]}', '{"a": [],}', '{1: []}'])
+def test_invalid_files(text):
+    with pytest.raises(ValueError):
+        list(iter_keyed_products(io.StringIO(text), 3))
+
+def test_iter_products(catalog, tmp_path):
+    products = [product for key, product in expected(catalog)]
+    json_file, lines_file = tmp_path / 'catalog.json', tmp_path / 'catalog.jsonl'
+    json_file.write_text(json.dumps(catalog))
+    lines_file.write_text(''.join(json.dumps(product) + '\n\n' for product in products))
+    assert list(iter_products(str(json_file))) == products
+    assert list(iter_products(str(lines_file))) == products
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'token_seed': 3, 'bits': 2, 'blocking': True}])
+def test_stream_equals_detect(tmp_path, kwargs):
+    data = generate_catalog(400, seed=9)
+    file = tmp_path / 'catalog.json'
+    file.write_text(json.dumps(data))
+    kwargs = {'token_seed': 0, **kwargs}
+    loaded = detect(data, 0.5, 0.5, metrics=Metrics(quiet=True), **kwargs)
+    streamed = detect_stream(str(file), 0.5, 0.5, metrics=Metrics(quiet=True), **kwargs)
+    assert loaded == streamed
@@ -0,0 +1,44 @@
+# The similarity join (with the PPJoin filters) must find exactly the pairs that a comparison of all pairs finds
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+from benchmark import generate_catalog
+from join import similarity_join
+from preprocessing import get_words
+from similarity import jaccard
+from tokens import intern_sets
+
+
+def brute_force(word_sets, threshold):
+    return [i * len(word_sets) + j for i, j in itertools.combinations(range(len(word_sets)), 2)
+            if word_sets[i] and word_sets[j] and (threshold <= 0 or jaccard(word_sets[i], word_sets[j]) >= threshold)]
+
+
+@pytest.fixture(scope='module')
+def catalog_sets():
+    return [get_words(product) for products in generate_catalog(400, seed=11).values() for product in products]
+
+@pytest.fixture(scope='module')
+def random_sets():
+    # Small sets over a small vocabulary, with empty sets and duplicates, to exercise the length and positional bounds
+    rng = random.Random(3)
+    vocabulary = ['w{}'.format(k) for k in range(12)]
+    return [set(rng.sample(vocabulary, rng.randint(0, 7))) for _ in range(300)]
+
+
+@pytest.mark.parametrize('threshold', [0.0, 0.1, 0.3, 0.5, 2/3, 0.75, 0.9, 1.0])
+def test_catalog(catalog_sets, threshold):
+    assert similarity_join(intern_sets(catalog_sets), threshold).tolist() == brute_force(catalog_sets, threshold)
+
+@pytest.mark.parametrize('threshold', [-1.0, 0.0, 0.2, 1/3, 0.4, 0.5, 0.6, 0.8, 1.0])
+def test_random_sets(random_sets, threshold):
+    keys = similarity_join(intern_sets(random_sets), threshold)
+    assert keys.tolist() == brute_force(random_sets, threshold)
+    assert keys.dtype == np.int64
+
+def test_empty():
+    assert len(similarity_join(intern_sets([set(), set()]), 0.5)) == 0
+    assert len(similarity_join(intern_sets([]), 0.0)) == 0
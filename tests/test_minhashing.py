@@ -0,0 +1,116 @@
+# Signatures: the vectorized minhash equals the original loop, and b-bit packing of signatures has an exact round trip,
+# agreement on the packed bytes and its correction for chance agreement
+import random
+
+import numpy as np
+import pytest
+
+from benchmark import generate_catalog
+from compare import signature_agreement
+from detect import prepare
+from lsh import band_keys
+from metrics import Metrics
+from minhashing import EMPTY, PackedSignatures, generate_minhash_funcs, incidence, minhash_rows, pack_signatures
+
+
+def loop_signatures(word_set, product_sets, hash_funcs, n, R):
+    # The original make_signatures, a loop over every word, hash function and product
+    M = np.ones((n, len(product_sets))) * np.inf
+    h_i = np.zeros(n)
+    for (row, w) in enumerate(word_set):
+        for h, (const, mult) in enumerate(hash_funcs):
+            h_i[h] = (const + mult * (row+1)) % R
+        for h, perm_row in enumerate(h_i):
+            for index, product_set in enumerate(product_sets):
+                if w in product_set:
+                    M[h, index] = min(M[h,index], perm_row)
+    return M
+
+
+@pytest.fixture(scope='module')
+def random_signatures():
+    rng = np.random.RandomState(0)
+    signatures = rng.randint(0, 2**32, size=(1155, 40), dtype=np.uint64).astype(np.uint32)
+    signatures[:, 1] = EMPTY  # A product without words
+    signatures[:, 2] = signatures[:, 3]
+    return signatures
+
+@pytest.fixture(scope='module')
+def catalog_signatures():
+    return np.asarray(prepare(generate_catalog(300, seed=2), metrics=Metrics(quiet=True))[4])
+
+
+@pytest.mark.parametrize('num_const, num_mult', [(105, 11), (3, 2)])
+@pytest.mark.parametrize('chunk_size', [1, 50, 2**22])
+def test_minhash_rows(num_const, num_mult, chunk_size):
+    # Products over a tiny vocabulary, with products without words and words outside the vocabulary
+    rng = random.Random(1)
+    vocabulary = ['w{}'.format(k) for k in range(8)]
+    product_sets = [set(rng.sample(vocabulary + ['x', 'y'], rng.randint(0, 5))) for _ in range(30)]
+    R = 2*3*5*7*11*13*17+19
+    hash_funcs = list(generate_minhash_funcs(num_const, num_mult, R))
+    n = len(hash_funcs)
+
+    expected = loop_signatures(vocabulary, product_sets, hash_funcs, n, R)
+    signatures = minhash_rows(*incidence(vocabulary, product_sets), hash_funcs, n, R, chunk_size)
+    assert (signatures == np.where(np.isinf(expected), EMPTY, expected)).all()
+    assert any(not product_set & set(vocabulary) for product_set in product_sets)
+
+@pytest.mark.parametrize('bits', [1, 2, 4, 8])
+@pytest.mark.parametrize('n', [1155, 13, 1])
+def test_round_trip(random_signatures, bits, n):
+    signatures = random_signatures[:n]
+    packed = pack_signatures(signatures, bits)
+    assert packed.dtype == np.uint8 and packed.shape == (-(-n * bits // 8), signatures.shape[1])
+    packed_signatures = PackedSignatures(packed, bits, n)
+    assert packed_signatures.shape == signatures.shape
+    assert (packed_signatures.values() == signatures & (2**bits - 1)).all()
+    assert (packed_signatures.values([3, 0]) == (signatures & (2**bits - 1))[:, [3, 0]]).all()
+
+@pytest.mark.parametrize('bits', [1, 2, 4, 8])
+def test_agreement_formula(random_signatures, bits):
+    # The agreement on the packed bytes equals the corrected fraction of equal b-bit values
+    packed_signatures = PackedSignatures(pack_signatures(random_signatures[:1001], bits), bits, 1001)
+    i1, i2 = np.triu_indices(random_signatures.shape[1], 1)
+    values = packed_signatures.values()
+    equal = (values[:, i1] == values[:, i2]).mean(axis=0)
+    chance = 2.0**-bits
+    assert np.allclose(packed_signatures.agreement(i1, i2), np.clip((equal - chance) / (1 - chance), 0, 1))
+    assert np.allclose(signature_agreement(packed_signatures, i1, i2), packed_signatures.agreement(i1, i2))
+    assert packed_signatures.agreement(np.array([2]), np.array([3]))[0] == 1.0
+
+@pytest.mark.parametrize('bits', [1, 2, 4, 8])
+@pytest.mark.parametrize('similarity', [0.0, 0.3, 0.7])
+def test_bias_correction(bits, similarity):
+    # Pairs sharing a fraction of their full values, the others independent: the estimate is unbiased on average
+    rng = np.random.RandomState(bits)
+    n, num_pairs = 1155, 400
+    first = rng.randint(0, 2**32, size=(n, num_pairs), dtype=np.uint64).astype(np.uint32)
+    second = rng.randint(0, 2**32, size=(n, num_pairs), dtype=np.uint64).astype(np.uint32)
+    shared = rng.random_sample((n, num_pairs)) < similarity
+    second[shared] = first[shared]
+    packed_signatures = PackedSignatures(pack_signatures(np.hstack([first, second]), bits), bits, n)
+    estimate = packed_signatures.agreement(np.arange(num_pairs), np.arange(num_pairs) + num_pairs)
+    if similarity == 0.0:
+        # Clipped at 0, so only about half the estimates are above 0 and these are small
+        assert estimate.mean() < 2 / np.sqrt(n)
+    else:
+        assert abs(estimate.mean() - shared.mean()) < 0.01
+
+@pytest.mark.parametrize('bits', [1, 2, 4, 8])
+def test_bias_on_catalog(catalog_signatures, bits):
+    # Pairs with a high full agreement are estimated with little bias from real signatures
+    i1, i2 = np.triu_indices(catalog_signatures.shape[1], 1)
+    full = (catalog_signatures[:, i1] == catalog_signatures[:, i2]).mean(axis=0)
+    similar = full >= 0.5
+    assert similar.sum() > 100
+    estimate = PackedSignatures(pack_signatures(catalog_signatures, bits), bits, len(catalog_signatures)).agreement(i1[similar], i2[similar])
+    assert abs((estimate - full[similar]).mean()) < 0.02
+
+@pytest.mark.parametrize('bits', [1, 2, 4, 8])
+def test_band_keys(catalog_signatures, bits):
+    # Packed signatures are bucketed on their b-bit values, also when these are unpacked in chunks
+    packed_signatures = PackedSignatures(pack_signatures(catalog_signatures, bits), bits, len(catalog_signatures))
+    expected = band_keys(packed_signatures.values(), r=21, b=55)
+    assert (band_keys(packed_signatures, r=21, b=55) == expected).all()
+    assert (band_keys(packed_signatures, r=21, b=55, chunk_size=5000) == expected).all()
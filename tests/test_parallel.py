@@ -0,0 +1,35 @@
+# Band-sharded candidate generation must give exactly the pairs of the serial bucketing, with and without blocking
+import numpy as np
+import pytest
+
+from benchmark import generate_catalog
+from blocking import blocked_bucket_pairs, shop_codes
+from compare import brand_codes
+from detect import prepare
+from lsh import band_buckets, bucket_pairs, bucket_sizes
+from metrics import Metrics
+from parallel import band_pairs
+
+
+@pytest.fixture(scope='module')
+def catalog():
+    flat_products, _, _, _, signatures = prepare(generate_catalog(300, seed=4), metrics=Metrics(quiet=True))
+    return np.asarray(signatures), shop_codes(flat_products), brand_codes(flat_products)
+
+
+@pytest.mark.parametrize('r, b', [(1155, 1), (21, 55), (7, 165), (3, 385)])
+@pytest.mark.parametrize('blocking', [False, True])
+def test_band_pairs(catalog, r, b, blocking):
+    signatures, shops, brands = catalog
+    num_products = signatures.shape[1]
+    products, starts = band_buckets(signatures, r=r, b=b)
+    if blocking:
+        expected, stats = blocked_bucket_pairs(products, starts, num_products, shops, brands)
+    else:
+        expected, stats = bucket_pairs(products, starts, num_products), None
+
+    pair_keys, frequencies, shard_stats = band_pairs(signatures, r, b, workers=2, shops=shops if blocking else None, brands=brands if blocking else None)
+    assert len(expected) > 0
+    assert pair_keys.tolist() == expected.tolist()
+    assert frequencies.tolist() == np.bincount(bucket_sizes(products, starts)).tolist()
+    assert shard_stats == stats
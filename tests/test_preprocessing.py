@@ -0,0 +1,38 @@
+# The memoized preprocessing must equal the original uncached functions
+import random
+
+import pytest
+
+from benchmark import generate_catalog
+from preprocessing import clean, clean_line, get_words, remove_chars, stop_words, strip_chars
+
+
+def reference_clean_line(line):
+    return line.lower().replace('inches', 'inch').replace('-inch', 'inch').replace(' inch', 'inch').replace('inch', "'").replace('hertz', 'hz').replace(' hz', 'hz').replace(' x ', 'x')
+
+def reference_clean(string):
+    return string.lower().translate({ord(c): None for c in remove_chars}).replace('”', "'").replace("''", "'").replace('"', "'").replace('–', '-').strip(strip_chars)
+
+def reference_get_words(product):
+    return {w for word in reference_clean_line(product['title']).split(' ') if (w := reference_clean(word)) not in stop_words}
+
+
+@pytest.fixture(scope='module')
+def products():
+    return [product for products in generate_catalog(2000, seed=7).values() for product in products]
+
+
+def test_get_words(products):
+    assert all(get_words(product) == reference_get_words(product) for product in products)
+    assert all(get_words({'title': clean_line(product['title'])}) == reference_get_words({'title': reference_clean_line(product['title'])}) for product in products)
+
+def test_clean_line_on_products(products):
+    lines = [product['title'] for product in products] + [v for product in products for v in product['featuresMap'].values()]
+    assert all(clean_line(line) == reference_clean_line(line) for line in lines)
+
+def test_random_strings():
+    rng = random.Random(0)
+    pieces = [' ', '-', 'inch', 'inches', 'hertz', 'hz', ' x ', 'x', 'es', 'i', 'h', "'", "''", '"', '”', '–', '(', ')', '[', ']', '&', '|', '.', ',', ':', '/', 'A', 'b', '1']
+    strings = [''.join(rng.choice(pieces) for _ in range(rng.randint(1, 12))) for _ in range(50000)]
+    assert all(clean_line(s) == reference_clean_line(s) for s in strings)
+    assert all(clean(s) == reference_clean(s) for s in strings)
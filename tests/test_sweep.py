@@ -0,0 +1,23 @@
+# The sweep over all band configurations and compare similarities at once must equal a detect per configuration
+import numpy as np
+import pytest
+
+from benchmark import generate_catalog
+from detect import detect, prepare
+from metrics import Metrics
+from optimize import sweep
+
+
+@pytest.fixture(scope='module')
+def data():
+    return generate_catalog(200, seed=6)
+
+
+def test_sweep_equals_detect(data):
+    compare_sims = np.linspace(0, 1, 11)
+    results = sweep(data, compare_sims, metrics=Metrics(quiet=True))
+    signatures = prepare(data, metrics=Metrics(quiet=True))[4]
+    assert len(results) == 16 * len(compare_sims)
+    for r, b, threshold, performance, compare_sim in results:
+        expected = detect(data, compare_similarity=compare_sim, lsh_similarity=threshold, pre_comp_signature=signatures, metrics=Metrics(quiet=True))
+        assert performance == expected, (r, b, compare_sim)